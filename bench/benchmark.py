@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import spotipy  # noqa: E402
+import streamlit as st  # noqa: E402
+import streamlit.logger  # noqa: E402
+from openai import OpenAI  # noqa: E402
+from spotipy.cache_handler import MemoryCacheHandler  # noqa: E402
+from spotipy.oauth2 import SpotifyOAuth  # noqa: E402
+
+from async_spotify_controller import AsyncSpotifyController  # noqa: E402
+from fake_servers import FakeSpotifyServer, FakeOpenAIServer, _track  # noqa: E402
+from library_index import LibraryIndex  # noqa: E402
+from menu import Menu  # noqa: E402
+from spotify_controller import SpotifyController, build_session  # noqa: E402
+
+# Runs scripted chat turns through Menu's chat and tool call path against local fake Spotify and OpenAI
+# servers, and reports how long they took:
+#   python bench/benchmark.py --save-baseline    records bench/baseline.json
+#   python bench/benchmark.py                    compares with it and exits with 1 on a regression
+# The tool calls of every scenario are also run through AsyncSpotifyController, which has to come up with
+# the same results as SpotifyController.
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SCENARIOS = {
+    'play': ('play Xtal by Aphex Twin', [('play_track', {'track_name': 'Xtal Aphex Twin'})]),
+    'queue_20': ('add twenty songs to my queue',
+                 [('add_to_queue', {'tracks': [f'Song {i} by Band {i}' for i in range(20)]})]),
+    'playlist_50': ('make me a playlist with fifty songs',
+                    [('create_playlist_with_tracks', {'name': 'Bench playlist',
+                                                      'tracks': [f'Tune {i} by Group {i}' for i in range(50)]})]),
+    # more candidates than the playlist takes, some of them unknown to the search and some repeated
+    'playlist_fill_30': ('make me a playlist with thirty songs',
+                         [('create_playlist_with_tracks', {
+                             'name': 'Bench fill', 'size': 30,
+                             'tracks': [f'Unknown {i} by Nobody' if i % 5 == 0 else f'Tune {i % 40} by Group {i % 40}'
+                                        for i in range(45)]})]),
+    'top_100': ('show my top 100 tracks', [('get_user_top_tracks', {'tracks': 100})]),
+}
+
+# phases reported for each scenario, all in milliseconds from the moment the user sends the message
+METRICS = ('first_token_ms', 'tool_ms', 'total_ms')
+
+
+def _build_menu(spotify: FakeSpotifyServer, openai: FakeOpenAIServer):
+    client = spotipy.Spotify(auth='bench-token', requests_session=build_session())
+    client.prefix = f'{spotify.url}/v1/'
+
+    # a fresh controller every turn, so each one starts with empty caches like a cold session would
+    controller = SpotifyController(credentials=None, scopes='', client=client)
+    openai_client = OpenAI(api_key='bench-key', base_url=f'{openai.url}/v1', max_retries=0)
+
+    menu = Menu.headless(controller, openai_client, controller.get_user_profile_name())
+
+    tool_time = []
+    lock = threading.Lock()
+
+    def timed(func):
+        def wrapper(**arguments):
+            start = time.perf_counter()
+            try:
+                return func(**arguments)
+            finally:
+                with lock:
+                    tool_time.append(time.perf_counter() - start)
+        return wrapper
+
+    menu.function_map = {name: {**entry, 'func': timed(entry['func'])} for name, entry in menu.function_map.items()}
+    return menu, tool_time
+
+
+def run_turn(spotify: FakeSpotifyServer, openai: FakeOpenAIServer, prompt: str, response_mode: str):
+    menu, tool_time = _build_menu(spotify, openai)
+
+    st.session_state.clear()
+    st.session_state['response_mode'] = response_mode
+    menu.conversation.append("assistant", menu._greeting())
+    menu.conversation.append("user", prompt)
+
+    start = time.perf_counter()
+    first_token = None
+
+    menu.stream = menu._request_completion()
+    for chunk in menu._stream_messages():
+        if chunk and first_token is None:
+            first_token = time.perf_counter()
+    end = time.perf_counter()
+
+    return {
+        'first_token_ms': ((first_token or end) - start) * 1000,
+        'tool_ms': sum(tool_time) * 1000,
+        'total_ms': (end - start) * 1000,
+    }
+
+
+def _library_index():
+    # knows some of the scenarios' tracks in other versions than the ones the search finds, so a controller that
+    # doesn't look tracks up in it first ends up with different ones
+    tracks = [_track(90_000, name='Xtal', artist='Aphex Twin')]
+    tracks += [_track(90_001 + i, name=f'Song {i}', artist=f'Band {i}') for i in range(0, 20, 3)]
+    tracks += [_track(90_100 + i, name=f'Tune {i}', artist=f'Group {i}') for i in range(0, 50, 4)]
+    index = LibraryIndex()
+    index.add(tracks, 'saved')
+    return index
+
+
+def _async_controller(spotify: FakeSpotifyServer):
+    # the fake server takes any token, this one never expires
+    token = {'access_token': 'bench-token', 'token_type': 'Bearer', 'scope': '',
+             'expires_at': int(time.time()) + 24 * 3600}
+    auth_manager = SpotifyOAuth(client_id='bench', client_secret='bench', redirect_uri='http://localhost',
+                                cache_handler=MemoryCacheHandler(token))
+    return AsyncSpotifyController(auth_manager=auth_manager, base_url=f'{spotify.url}/v1/',
+                                  library_index=_library_index())
+
+
+def _outcome(spotify: FakeSpotifyServer, response):
+    # what a tool call did: its reply with playlist ids left out, the tracks of the playlist it created and
+    # what's queued and playing afterwards
+    message = str(response)
+    playlist = re.search(r'/playlist/(\w+)', message)
+    tracks = spotify.playlists[playlist.group(1)] if playlist else None
+    return re.sub(r'/playlist/\w+', '/playlist/', message), tracks, list(spotify.queue), spotify.current['uri']
+
+
+def _reset_playback(spotify: FakeSpotifyServer):
+    spotify.queue.clear()
+    spotify.current = _track(0)
+
+
+def check_async(spotify: FakeSpotifyServer, scenarios: list):
+    # returns the tool calls of the scenarios AsyncSpotifyController does something else for
+    async def run_async(calls):
+        _reset_playback(spotify)
+        async with _async_controller(spotify) as controller:
+            outcomes = [_outcome(spotify, await getattr(controller, name)(**arguments)) for name, arguments in calls]
+            return outcomes, controller.last_playlist_report
+
+    mismatches = []
+    for name in scenarios:
+        calls = SCENARIOS[name][1]
+        client = spotipy.Spotify(auth='bench-token', requests_session=build_session())
+        client.prefix = f'{spotify.url}/v1/'
+        controller = SpotifyController(credentials=None, scopes='', client=client)
+        controller.library_index = _library_index()
+        _reset_playback(spotify)
+        expected = [_outcome(spotify, getattr(controller, call)(**arguments)) for call, arguments in calls]
+
+        outcomes, report = asyncio.run(run_async(calls))
+        if outcomes != expected:
+            mismatches.append(f'{name}: results differ')
+        elif _counts(report) != _counts(controller.last_playlist_report):
+            mismatches.append(f'{name}: playlist stages differ')
+    return mismatches
+
+
+def _counts(report: list):
+    # items in and out of every playlist stage, the timings differ of course
+    return [(row['stage'], row['in'], row['out']) for row in report or []]
+
+
+def run(args):
+    script = {prompt: calls for prompt, calls in SCENARIOS.values()}
+    results = {}
+
+    with FakeSpotifyServer(latency=args.spotify_latency, top_total=args.top_total) as spotify, \
+            FakeOpenAIServer(latency=args.openai_latency, token_interval=args.token_interval,
+                             reply_tokens=args.reply_tokens, script=script) as openai:
+        for name in args.scenarios:
+            prompt = SCENARIOS[name][0]
+            runs = [run_turn(spotify, openai, prompt, args.response_mode) for _ in range(args.runs)]
+            results[name] = {metric: statistics.median(run[metric] for run in runs) for metric in METRICS}
+        mismatches = check_async(spotify, args.scenarios)
+
+    return results, mismatches
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(name, {}).get(metric)
+            # a few milliseconds of noise on very fast phases aren't worth reporting
+            if previous is not None and value > previous * (1 + tolerance) and value - previous > 5:
+                regressions.append(f'{name} {metric}: {previous:.1f} -> {value:.1f} ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline latency benchmark of spotbot chat turns')
+    parser.add_argument('scenarios', nargs='*', help=f'any of {", ".join(SCENARIOS)}, all by default')
+    parser.add_argument('--runs', type=int, default=5, help='turns per scenario, the median is reported')
+    parser.add_argument('--response-mode', default='hybrid')
+    parser.add_argument('--spotify-latency', type=float, default=0.03, help='seconds per Spotify request')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='seconds to the first token')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='seconds between streamed chunks')
+    parser.add_argument('--reply-tokens', type=int, default=30, help='length of streamed replies')
+    parser.add_argument('--top-total', type=int, default=200, help='number of top tracks and artists')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    # Menu is driven outside of a Streamlit page, which Streamlit warns about on every session_state access
+    streamlit.logger.set_log_level('error')
+    logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+
+    results, mismatches = run(args)
+
+    print(f'{"scenario":<14}' + ''.join(f'{metric:>16}' for metric in METRICS))
+    for name, metrics in results.items():
+        print(f'{name:<14}' + ''.join(f'{metrics[metric]:>16.1f}' for metric in METRICS))
+
+    if mismatches:
+        print('\nAsyncSpotifyController differs from SpotifyController:\n' + '\n'.join(mismatches))
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'\nbaseline saved to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print('\nregressions against the baseline:\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print('\nno regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-ins for the parts of Spotify Web API and OpenAI chat completions API spotbot uses,
+# so its latency can be measured without real accounts. Every response is delayed by `latency` seconds.
+
+
+class _FakeServer:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._dispatch(self, 'GET')
+
+            def do_POST(self):
+                server._dispatch(self, 'POST')
+
+            def do_PUT(self):
+                server._dispatch(self, 'PUT')
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._httpd.server_address[1]}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _dispatch(self, handler, method):
+        with self._lock:
+            self.requests += 1
+
+        url = urlparse(handler.path)
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        payload = json.loads(body) if body else None
+
+        time.sleep(self.latency)
+        self.handle(handler, method, url.path, {key: values[0] for key, values in parse_qs(url.query).items()},
+                    payload)
+
+    def handle(self, handler, method, path, params, payload):
+        raise NotImplementedError
+
+    @staticmethod
+    def _send_json(handler, status, data=None, headers=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def _track(index: int, name: str = None, artist: str = None):
+    name = name or f'Track {index}'
+    track_id = f'track{index:06d}'
+    return {
+        'id': track_id,
+        'uri': f'spotify:track:{track_id}',
+        'name': name,
+        'duration_ms': 200_000,
+        'artists': [{'id': f'artist{index % 97:04d}', 'name': artist or f'Artist {index % 97}'}],
+        'album': {'name': f'Album {index % 31}', 'images': []},
+        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+    }
+
+
+class FakeSpotifyServer(_FakeServer):
+    # top_total - how many top tracks and artists the user has, saved_total - size of the user's library,
+    # unknown_queries - search queries containing any of these words return no results
+    def __init__(self, latency: float = 0.02, top_total: int = 200, saved_total: int = 300,
+                 unknown_queries=('unknown',)):
+        super().__init__(latency)
+        self.top_total = top_total
+        self.saved_total = saved_total
+        self.unknown_queries = unknown_queries
+
+        self.is_playing = True
+        self.current = _track(0)
+        self.queue = []
+        self.playlists = {}
+        # responses to return instead of the next requests, e.g. (429, {'Retry-After': '1'})
+        self.injected_errors = []
+
+    def handle(self, handler, method, path, params, payload):
+        path = path.removeprefix('/v1').rstrip('/')
+
+        with self._lock:
+            if self.injected_errors:
+                status, headers = self.injected_errors.pop(0)
+                return self._send_json(handler, status, {'error': {'status': status, 'message': 'injected'}},
+                                       headers)
+
+        if method == 'GET' and path == '/me':
+            return self._send_json(handler, 200, {
+                'id': 'bench-user', 'display_name': 'Bench User',
+                'external_urls': {'spotify': 'https://open.spotify.com/user/bench-user'},
+                'images': [{'url': 'https://i.scdn.co/image/bench'}],
+            })
+
+        if method == 'GET' and path == '/search':
+            return self._search(handler, params)
+
+        if method == 'GET' and path == '/me/player':
+            return self._send_json(handler, 200, {
+                'is_playing': self.is_playing, 'progress_ms': 1000, 'item': self.current,
+                'device': {'id': 'bench-device', 'is_active': True},
+            })
+
+        if method == 'GET' and path == '/me/player/devices':
+            return self._send_json(handler, 200, {'devices': [{'id': 'bench-device', 'is_active': True,
+                                                               'name': 'bench'}]})
+
+        if method == 'POST' and path == '/me/player/queue':
+            self.queue.append(params['uri'])
+            return self._send_json(handler, 204)
+
+        if method == 'POST' and path in ('/me/player/next', '/me/player/previous'):
+            if path.endswith('next') and self.queue:
+                index = int(self.queue.pop(0).rsplit('track', 1)[1])
+                self.current = _track(index)
+            return self._send_json(handler, 204)
+
+        if method == 'PUT' and path in ('/me/player/pause', '/me/player/play'):
+            self.is_playing = path.endswith('play')
+            return self._send_json(handler, 204)
+
+        if method == 'POST' and (match := re.fullmatch(r'/users/([^/]+)/playlists', path)):
+            playlist_id = f'playlist{len(self.playlists)}'
+            self.playlists[playlist_id] = []
+            return self._send_json(handler, 201, {
+                'id': playlist_id, 'name': payload['name'],
+                'external_urls': {'spotify': f'https://open.spotify.com/playlist/{playlist_id}'},
+            })
+
+        if method == 'POST' and (match := re.fullmatch(r'/playlists/([^/]+)/(tracks|items)', path)):
+            uris = payload['uris'] if isinstance(payload, dict) else payload
+            if len(uris) > 100:
+                return self._send_json(handler, 400, {'error': {'status': 400, 'message': 'Too many ids'}})
+            self.playlists.setdefault(match.group(1), []).extend(uris)
+            return self._send_json(handler, 201, {'snapshot_id': 'snapshot'})
+
+        if method == 'GET' and (match := re.fullmatch(r'/me/top/(tracks|artists)', path)):
+            return self._page(handler, params, self.top_total,
+                              _track if match.group(1) == 'tracks' else self._artist)
+
+        if method == 'GET' and path == '/me/tracks':
+            return self._page(handler, params, self.saved_total,
+                              lambda i: {'added_at': '2024-01-01T00:00:00Z', 'track': _track(i)})
+
+        if method == 'GET' and path == '/me/player/recently-played':
+            limit = int(params.get('limit', 50))
+            return self._send_json(handler, 200, {'items': [{'played_at': '2024-01-01T00:00:00Z',
+                                                             'track': _track(i)} for i in range(limit)]})
+
+        self._send_json(handler, 404, {'error': {'status': 404, 'message': f'{method} {path} is not faked'}})
+
+    def _search(self, handler, params):
+        query = params.get('q', '')
+        limit = int(params.get('limit', 10))
+
+        if any(word in query.lower() for word in self.unknown_queries):
+            items = []
+        else:
+            # the same query always resolves to the same tracks, the first one is the asked for title and artist
+            base = zlib.crc32(query.encode()) % 100_000
+            title, _, artist = query.partition(' by ')
+            items = [_track(base + i, name=title, artist=artist or None) if i == 0 else _track(base + i)
+                     for i in range(limit)]
+
+        self._send_json(handler, 200, {'tracks': {'items': items, 'total': len(items), 'limit': limit}})
+
+    def _page(self, handler, params, total, make_item):
+        limit = int(params.get('limit', 20))
+        offset = int(params.get('offset', 0))
+        items = [make_item(i) for i in range(offset, min(offset + limit, total))]
+        self._send_json(handler, 200, {'items': items, 'total': total, 'limit': limit, 'offset': offset})
+
+    @staticmethod
+    def _artist(index: int):
+        return {'id': f'artist{index:04d}', 'name': f'Artist {index}', 'uri': f'spotify:artist:artist{index:04d}'}
+
+
+class FakeOpenAIServer(_FakeServer):
+    # Streams chat completions. If the request offers tools and the last user message is in `script`,
+    # the scripted tool calls are streamed, otherwise a reply of `reply_tokens` tokens is.
+    # `latency` is the time to first token, `token_interval` the time between following chunks.
+    def __init__(self, latency: float = 0.3, token_interval: float = 0.01, reply_tokens: int = 30,
+                 script: dict = None):
+        super().__init__(latency)
+        self.token_interval = token_interval
+        self.reply_tokens = reply_tokens
+        self.script = script or {}
+
+    def handle(self, handler, method, path, params, payload):
+        if method != 'POST' or not path.endswith('/chat/completions'):
+            return self._send_json(handler, 404, {'error': {'message': f'{method} {path} is not faked'}})
+
+        user_messages = [message for message in payload['messages'] if message['role'] == 'user']
+        prompt = user_messages[-1]['content'] if user_messages else ''
+
+        if payload.get('tools') and prompt in self.script:
+            deltas = self._tool_call_deltas(self.script[prompt])
+        else:
+            deltas = [{'role': 'assistant', 'content': ''}] + [{'content': f'word{i} '}
+                                                               for i in range(self.reply_tokens)]
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+
+        for i, delta in enumerate(deltas):
+            if i:
+                time.sleep(self.token_interval)
+            self._send_event(handler, {'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+
+        self._send_event(handler, {'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            prompt_tokens = len(json.dumps(payload)) // 4
+            self._send_event(handler, {'choices': [], 'usage': {
+                'prompt_tokens': prompt_tokens, 'completion_tokens': len(deltas),
+                'total_tokens': prompt_tokens + len(deltas), 'prompt_tokens_details': {'cached_tokens': 0},
+            }})
+        handler.wfile.write(b'data: [DONE]\n\n')
+        handler.wfile.flush()
+        handler.close_connection = True
+
+    @staticmethod
+    def _tool_call_deltas(calls: list):
+        # arguments are streamed in small fragments, just like the real API does
+        deltas = []
+        for index, (name, arguments) in enumerate(calls):
+            deltas.append({'tool_calls': [{'index': index, 'id': f'call_{index}', 'type': 'function',
+                                           'function': {'name': name, 'arguments': ''}}]})
+            encoded = json.dumps(arguments)
+            for start in range(0, len(encoded), 12):
+                deltas.append({'tool_calls': [{'index': index,
+                                               'function': {'arguments': encoded[start:start + 12]}}]})
+        return deltas
+
+    @staticmethod
+    def _send_event(handler, data: dict):
+        chunk = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'gpt-4o-mini',
+                 **data}
+        handler.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        handler.wfile.flush()
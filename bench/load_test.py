@@ -0,0 +1,237 @@
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+import streamlit.logger  # noqa: E402
+from streamlit.runtime import Runtime  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+import resources  # noqa: E402
+from fake_servers import FakeSpotifyServer, FakeOpenAIServer  # noqa: E402
+
+# Runs many chat sessions of the real app (src/main.py, through Streamlit's AppTest) at once against local
+# fake Spotify and OpenAI servers, ramping the number of concurrent sessions, to see where one process
+# stops keeping up:
+#   python bench/load_test.py --levels 1 5 10 20 --save load.json
+#   python bench/load_test.py --compare load.json
+
+# (weight, prompt, tool calls the fake model makes for it), roughly how people use the chat:
+# mostly short playback commands answered without the model, some searches and a few heavy requests
+COMMAND_MIX = [
+    (25, 'pause', None),
+    (20, 'next', None),
+    (15, "what's playing", None),
+    (15, 'play Xtal by Aphex Twin', [('play_track', {'track_name': 'Xtal Aphex Twin'})]),
+    (10, 'queue five songs', [('add_to_queue', {'tracks': [f'Song {i} by Band {i}' for i in range(5)]})]),
+    (5, 'make me a playlist with twenty songs',
+     [('create_playlist_with_tracks', {'name': 'Load playlist', 'tracks': [f'Tune {i}' for i in range(20)]})]),
+    (5, 'show my top 20 tracks', [('get_user_top_tracks', {'tracks': 20})]),
+    (5, 'tell me something about jazz', None),
+]
+
+METRICS = ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'page_load_ms', 'errors', 'threads', 'rss_mb',
+           'rss_kb_per_session')
+
+
+def keep_runtime():
+    # AppTest sets up a runtime for every run and removes it when the run ends, pulling it from under
+    # the runs of other sessions still going, so the runtime of the latest run is kept around
+    latest = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            latest[:] = [cls._instance]
+        if not latest:
+            raise RuntimeError("Runtime hasn't been created!")
+        return latest[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(latest))
+
+
+def rss_kb():
+    # current resident set size, or the peak one where /proc isn't there
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _percentile(values: list, quantile: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+def write_secrets(directory: str, spotify: FakeSpotifyServer):
+    with open(os.path.join(directory, 'secrets.json'), 'w') as file:
+        json.dump({'spotify': {'client_id': 'load', 'client_secret': 'load', 'redirect_uri': 'http://localhost:8501',
+                               'api_url': f'{spotify.url}/v1/'},
+                   'openai': {'key': 'load-key'}}, file)
+
+
+def log_in():
+    # a session that already went through Spotify's login, its token stays valid for the whole test
+    session_key = uuid.uuid4().hex
+    resources.get_token_store().set(session_key, {
+        'access_token': 'load-token', 'token_type': 'Bearer', 'refresh_token': 'load-refresh',
+        'scope': resources.SCOPES.replace(',', ' '), 'expires_in': 3600, 'expires_at': int(time.time()) + 24 * 3600,
+    })
+    return session_key
+
+
+def run_session(turns: int, think_time: float, seed: int, results: list, lock: threading.Lock):
+    rng = random.Random(seed)
+    weights = [weight for weight, _, _ in COMMAND_MIX]
+
+    app = AppTest.from_file(os.path.join(SRC, 'main.py'), default_timeout=120)
+    # AppTest sends no cookies, so the session key the browser's cookie would bring goes in directly
+    app.session_state['session_key'] = log_in()
+
+    start = time.perf_counter()
+    app.run()
+    page_load = time.perf_counter() - start
+    errors = len(app.exception)
+
+    latencies = []
+    for _ in range(turns):
+        time.sleep(rng.uniform(0, think_time))
+        prompt = rng.choices(COMMAND_MIX, weights)[0][1]
+
+        start = time.perf_counter()
+        try:
+            app.chat_input[0].set_value(prompt).run()
+            failed = bool(app.exception)
+        except Exception:
+            failed = True
+        latencies.append(time.perf_counter() - start)
+        errors += failed
+
+    with lock:
+        results.append({'page_load': page_load, 'latencies': latencies, 'errors': errors})
+
+
+def run_level(sessions: int, args, rss_before: int):
+    results = []
+    lock = threading.Lock()
+    peak_threads = threading.active_count()
+
+    threads = [threading.Thread(target=run_session, args=(args.turns, args.think_time, args.seed + i, results, lock))
+               for i in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for result in results for latency in result['latencies']]
+    rss = rss_kb()
+    return {
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'page_load_ms': statistics.median(result['page_load'] for result in results) * 1000,
+        'errors': sum(result['errors'] for result in results),
+        'threads': peak_threads,
+        'rss_mb': rss / 1024,
+        'rss_kb_per_session': (rss - rss_before) / sessions,
+    }
+
+
+def run(args):
+    script = {prompt: calls for _, prompt, calls in COMMAND_MIX if calls}
+    results = {}
+
+    with FakeSpotifyServer(latency=args.spotify_latency) as spotify, \
+            FakeOpenAIServer(latency=args.openai_latency, token_interval=args.token_interval,
+                             script=script) as openai, \
+            tempfile.TemporaryDirectory() as directory:
+        # the app reads secrets.json and keeps its caches in the working directory
+        working_directory = os.getcwd()
+        os.chdir(directory)
+        write_secrets(directory, spotify)
+        os.environ['OPENAI_BASE_URL'] = f'{openai.url}/v1'
+
+        # imports and process-wide clients and caches are set up by the first session, not counted in any level
+        run_session(1, 0, args.seed, [], threading.Lock())
+
+        for sessions in args.levels:
+            rss_before = rss_kb()
+            results[str(sessions)] = run_level(sessions, args, rss_before)
+            print(f'{sessions:>8}' + ''.join(f'{results[str(sessions)][metric]:>20.1f}' for metric in METRICS),
+                  flush=True)
+
+        os.chdir(working_directory)
+
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    lines = []
+    for level, metrics in results.items():
+        previous = baseline.get(level)
+        if previous is None:
+            continue
+        changes = [f'{metric} {previous[metric]:.1f} -> {metrics[metric]:.1f}'
+                   for metric in ('throughput', 'p95_ms', 'rss_kb_per_session') if metric in previous]
+        lines.append(f'{level} sessions: ' + ', '.join(changes))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent session load test of spotbot')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 5, 10, 20],
+                        help='numbers of concurrent sessions to ramp through, each level starts new sessions')
+    parser.add_argument('--turns', type=int, default=10, help='chat turns per session')
+    parser.add_argument('--think-time', type=float, default=1.0, help='most seconds a user waits between turns')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the command mix')
+    parser.add_argument('--spotify-latency', type=float, default=0.03, help='seconds per Spotify request')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='seconds to the first token')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='seconds between streamed chunks')
+    parser.add_argument('--save', help='store results in this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+    # the test runs in a temporary working directory
+    args.save = args.save and os.path.abspath(args.save)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    # sessions run outside of a Streamlit server, which Streamlit and spotipy are loud about
+    streamlit.logger.set_log_level('error')
+    logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+    logging.getLogger('spotbot').setLevel(logging.ERROR)
+    keep_runtime()
+
+    print(f'{"sessions":>8}' + ''.join(f'{metric:>20}' for metric in METRICS))
+    results = run(args)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            print('\ncompared with ' + args.compare + ':\n' + '\n'.join(compare(results, json.load(file))))
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'\nresults saved to {args.save}')
+
+
+if __name__ == '__main__':
+    main()
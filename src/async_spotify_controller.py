@@ -0,0 +1,304 @@
+import asyncio
+
+import httpx
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+
+from library_index import LibraryIndex
+from playback_state import PlaybackState
+from playlist_pipeline import AsyncPlaylistPipeline, TOP_K
+from records import ArtistRecord, TrackRecord
+from search_cache import SearchCache, NOT_CACHED, normalize_query
+from spotify_controller import (Response, PLAYLIST_ADD_LIMIT, MAX_SEARCH_WORKERS, _describe_playlist,
+                                _describe_resolution)
+from top_items import TopItemsCache, DEFAULT_TIME_RANGE, PAGE_SIZE
+from tracing import traced
+
+API_URL = 'https://api.spotify.com/v1/'
+# how many times a request rejected with 429 is retried after waiting for Retry-After
+MAX_RATE_LIMIT_RETRIES = 3
+
+
+@traced('spotify_async')
+class AsyncSpotifyController:
+    # asyncio counterpart of SpotifyController with the same public methods, all of them coroutines.
+    # Every request goes through one httpx.AsyncClient, so connections are pooled and kept alive,
+    # and many requests can be in flight on a single event loop.
+    def __init__(self, credentials=None, scopes: str = None, search_cache: SearchCache = None,
+                 top_items_cache: TopItemsCache = None, auth_manager=None, base_url: str = API_URL,
+                 max_connections: int = 20, library_index: LibraryIndex = None):
+        self.search_cache = search_cache if search_cache is not None else SearchCache()
+        self.top_items_cache = top_items_cache if top_items_cache is not None else TopItemsCache()
+        self.playback_state = PlaybackState()
+        # an index of the user's library playlists look tracks up in first, e.g. the one a SpotifyController
+        # of the same user keeps up to date
+        self.library_index = library_index
+        # stage by stage timing and hit rates of the last created playlist, see PlaylistPipeline.report
+        self.last_playlist_report = None
+
+        # auth_manager is anything with spotipy's SpotifyOAuth interface, e.g. a stand-in for a fake server
+        self.auth_manager = auth_manager or SpotifyOAuth(scope=scopes,
+                                                         client_id=credentials['spotify']['client_id'],
+                                                         client_secret=credentials['spotify']['client_secret'],
+                                                         redirect_uri=credentials['spotify']['redirect_uri'])
+
+        self.client = httpx.AsyncClient(base_url=base_url,
+                                        timeout=10,
+                                        limits=httpx.Limits(max_connections=max_connections,
+                                                            max_keepalive_connections=max_connections))
+
+        self._token_info = None
+        self._token_lock = asyncio.Lock()
+        self._user_id = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _get_access_token(self, force_refresh=False):
+        async with self._token_lock:
+            if force_refresh or self._token_info is None or self.auth_manager.is_token_expired(self._token_info):
+                # spotipy's OAuth is blocking, so it's kept off the event loop
+                self._token_info = await asyncio.to_thread(self._fetch_token_info, force_refresh)
+            return self._token_info['access_token']
+
+    def _fetch_token_info(self, force_refresh):
+        if self._token_info is not None and self._token_info.get('refresh_token'):
+            if force_refresh or self.auth_manager.is_token_expired(self._token_info):
+                return self.auth_manager.refresh_access_token(self._token_info['refresh_token'])
+
+        token_info = self.auth_manager.validate_token(self.auth_manager.cache_handler.get_cached_token())
+        if token_info is None:
+            # no usable token yet, it runs the authorization flow just like spotipy.Spotify does
+            self.auth_manager.get_access_token(as_dict=False)
+            token_info = self.auth_manager.cache_handler.get_cached_token()
+        return token_info
+
+    async def _request(self, method: str, path: str, params: dict = None, payload: dict = None):
+        token = await self._get_access_token()
+        refreshed = False
+        retries = 0
+
+        while True:
+            response = await self.client.request(method, path, params=params, json=payload,
+                                                 headers={'Authorization': f'Bearer {token}'})
+
+            if response.status_code == 401 and not refreshed:
+                token = await self._get_access_token(force_refresh=True)
+                refreshed = True
+                continue
+
+            if response.status_code == 429 and retries < MAX_RATE_LIMIT_RETRIES:
+                retries += 1
+                await asyncio.sleep(float(response.headers.get('Retry-After', 1)))
+                continue
+
+            break
+
+        if response.status_code >= 400:
+            try:
+                message = response.json()['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = response.text
+            raise spotipy.SpotifyException(response.status_code, -1, f'{response.url}:\n {message}',
+                                           headers=response.headers)
+
+        if not response.content:
+            return None
+        return response.json()
+
+    async def _get_user_id(self):
+        if self._user_id is None:
+            self._user_id = (await self._request('GET', 'me'))['id']
+        return self._user_id
+
+    async def _get_current_playback(self, refresh=False):
+        if not refresh:
+            fresh, playback = self.playback_state.cached()
+            if fresh:
+                return playback
+
+        playback = await self._request('GET', 'me/player')
+        self.playback_state.set(playback)
+        return playback
+
+    async def _change_playback(self, method: str, path: str, params: dict = None, **optimistic_changes):
+        try:
+            await self._request(method, path, params=params)
+        except spotipy.SpotifyException:
+            await self._get_current_playback(refresh=True)
+            raise
+
+        if optimistic_changes:
+            self.playback_state.update(**optimistic_changes)
+        else:
+            self.playback_state.invalidate()
+
+    async def _create_playlist(self, name: str):
+        user_id = await self._get_user_id()
+        return await self._request('POST', f'users/{user_id}/playlists', payload={'name': name, 'public': True})
+
+    async def get_user_profile_name(self):
+        user = await self._request('GET', 'me')
+        self._user_id = user['id']
+        return user['display_name'], user['external_urls']['spotify'], user['images'][0]['url']
+
+    async def _fetch_top_items(self, kind: str, count=50, time_range=DEFAULT_TIME_RANGE):
+        user_id = await self._get_user_id()
+
+        cached = self.top_items_cache.get(user_id, kind, time_range, count)
+        if cached is not None:
+            return cached
+
+        async def fetch(offset):
+            return await self._request('GET', f'me/top/{kind}', params={'limit': min(PAGE_SIZE, count - offset),
+                                                                        'offset': offset,
+                                                                        'time_range': time_range})
+
+        first_page = await fetch(0)
+        total = first_page['total']
+        pages = await asyncio.gather(*map(fetch, range(PAGE_SIZE, min(count, total), PAGE_SIZE)))
+
+        items = first_page['items'] + [item for page in pages for item in page['items']]
+        self.top_items_cache.set(user_id, kind, time_range, items, total)
+        return items
+
+    async def _search_track(self, query: str):
+        # same as in SpotifyController, tracks from the user's own library are found without asking Spotify
+        if self.library_index is not None:
+            uri = self.library_index.lookup(query)
+            if uri is not None:
+                return uri
+
+        cached = self.search_cache.get(query)
+        if cached is not NOT_CACHED:
+            return cached
+
+        result = await self._request('GET', 'search', params={'q': query, 'limit': 1, 'type': 'track'})
+        items = result['tracks']['items']
+        uri = items[0]['uri'] if items else None
+
+        self.search_cache.set(query, uri)
+        return uri
+
+    async def _search_tracks(self, query: str, limit: int = TOP_K):
+        result = await self._request('GET', 'search', params={'q': query, 'limit': limit, 'type': 'track'})
+        return result['tracks']['items']
+
+    async def _resolve_tracks(self, tracks: list):
+        if not tracks:
+            return []
+
+        semaphore = asyncio.Semaphore(MAX_SEARCH_WORKERS)
+
+        async def search(query):
+            async with semaphore:
+                return await self._search_track(query)
+
+        queries = list({normalize_query(track): track for track in tracks}.values())
+        uris = dict(zip(map(normalize_query, queries), await asyncio.gather(*map(search, queries))))
+
+        return [(track, uris[normalize_query(track)]) for track in tracks]
+
+    async def is_device_active(self):
+        for device in (await self._request('GET', 'me/player/devices'))['devices']:
+            if device['is_active']:
+                return True
+        return False
+
+    async def play_track(self, track_uri=None, track_name=None):
+        if track_uri:
+            await self._request('POST', 'me/player/queue', params={'uri': track_uri})
+            await self._change_playback('POST', 'me/player/next')
+        if track_name:
+            track = await self._search_track(track_name)
+            if track is None:
+                return Response(f'Could not find {track_name}', success=False)
+
+            # same as in SpotifyController, starting playback directly would erase the queue
+            await self._request('POST', 'me/player/queue', params={'uri': track})
+            await self._change_playback('POST', 'me/player/next')
+        else:
+            return None
+        return Response(track_name)
+
+    async def pause_playback(self):
+        current_playback = await self._get_current_playback()
+        if current_playback is not None and current_playback['is_playing']:
+            await self._change_playback('PUT', 'me/player/pause', is_playing=False)
+            return Response('Stopped playback')
+        else:
+            return Response('Playback is already paused')
+
+    async def resume_playback(self):
+        current_playback = await self._get_current_playback()
+        if current_playback is None or not current_playback['is_playing']:
+            await self._change_playback('PUT', 'me/player/play', is_playing=True)
+            return Response('Resumed playback')
+        else:
+            return Response('Playback is already playing')
+
+    async def add_to_queue(self, tracks):
+        added, missing = [], []
+
+        for track, uri in await self._resolve_tracks(tracks):
+            if uri is not None:
+                await self._request('POST', 'me/player/queue', params={'uri': uri})
+                added.append(track)
+            else:
+                missing.append(track)
+
+        return Response(_describe_resolution(added, missing), success=bool(added))
+
+    async def switch_to_next_track(self):
+        await self._change_playback('POST', 'me/player/next')
+
+        return Response('to the next track')
+
+    async def switch_to_previous_track(self):
+        await self._change_playback('POST', 'me/player/previous')
+        return Response('Switching to previous track...')
+
+    async def get_user_current_playback(self):
+        current_playback = await self._get_current_playback()
+
+        if current_playback is not None and current_playback['item'] is not None:
+            track_name = current_playback["item"]["name"]
+            artist_name = current_playback["item"]["artists"][0]["name"]
+            return Response(track_name + f' by {artist_name}')
+        else:
+            return Response('No track is currently playing')
+
+    async def create_playlist_with_tracks(self, name: str, tracks: list, size: int = None):
+        # tracks are candidates, best first, of which `size` distinct ones make it into the playlist,
+        # the playlist is created while the first ones are searched for
+        creating = asyncio.ensure_future(self._create_playlist(name))
+
+        async def add(uris):
+            playlist = await creating
+            for i in range(0, len(uris), PLAYLIST_ADD_LIMIT):
+                await self._request('POST', f'playlists/{playlist["id"]}/tracks',
+                                    payload={'uris': uris[i:i + PLAYLIST_ADD_LIMIT]})
+
+        size = size or len(tracks)
+        pipeline = AsyncPlaylistPipeline(self._search_tracks, add, size, library_index=self.library_index,
+                                         search_cache=self.search_cache, max_workers=MAX_SEARCH_WORKERS)
+        uris, missing = await pipeline.run(tracks)
+        self.last_playlist_report = pipeline.report()
+
+        return Response(_describe_playlist(await creating, uris, size, missing))
+
+    async def get_user_top_tracks(self, tracks=50, time_range=DEFAULT_TIME_RANGE):
+        top_tracks = await self._fetch_top_items('tracks', tracks, time_range)
+
+        return Response(records=[TrackRecord.from_track(track) for track in top_tracks])
+
+    async def get_user_top_artists(self, tracks=50, time_range=DEFAULT_TIME_RANGE):
+        top_artists = await self._fetch_top_items('artists', tracks, time_range)
+
+        return Response(records=[ArtistRecord.from_artist(artist) for artist in top_artists])
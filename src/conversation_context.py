@@ -0,0 +1,130 @@
+import json
+
+# rough estimate for English text, good enough to keep the prompt within budget without a tokenizer
+CHARS_PER_TOKEN = 4
+# every chat message costs a few tokens on top of its content
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _message_tokens(message: dict):
+    return estimate_tokens(message['content'] or '') + MESSAGE_OVERHEAD
+
+
+def _shorten(text: str, chars: int):
+    text = ' '.join(text.split())
+    return text if len(text) <= chars else text[:chars].rstrip() + '…'
+
+
+class ConversationContext:
+    # Decides which part of the chat history is sent to the model. The system prompt (and the tool schema,
+    # which the API puts in front of the messages) always go first and don't change, so provider-side prompt
+    # caching can reuse them. The last keep_turns turns are sent as they are, older ones are folded into a
+    # rolling summary that grows one turn at a time. A turn is a user message with the replies that follow it.
+    # History messages carry the seq a Conversation gave them, so the summary keeps its place while older
+    # messages leave the conversation's window.
+    def __init__(self, token_budget: int = 4000, keep_turns: int = 6,
+                 summary_tokens: int = 600, message_chars: int = 1500, summary_chars: int = 160):
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        # longest a single recent message can be, e.g. a pasted list of a hundred top tracks
+        self.message_chars = message_chars
+        # how much of each older message makes it into the summary
+        self.summary_chars = summary_chars
+
+        self.summary_lines = []
+        # seq of the first history message not folded into the summary yet
+        self.summarized_until = 0
+
+        self.last_stats = {}
+        self.last_usage = {}
+
+    def build(self, messages: list, tools: list = None):
+        system, history = messages[0], messages[1:]
+        prefix_tokens = _message_tokens(system) + (estimate_tokens(json.dumps(tools)) if tools else 0)
+
+        recent_start = self._recent_start(history, self.keep_turns)
+        self._fold(history[self._unsummarized(history):recent_start])
+        recent = [self._compact(message) for message in history[recent_start:]]
+
+        # if recent turns alone don't fit, older of them are folded as well, keeping at least the last turn
+        keep_turns = self.keep_turns
+        while keep_turns > 1 and prefix_tokens + self._summary_tokens() + self._tokens(recent) > self.token_budget:
+            keep_turns -= 1
+            new_start = self._recent_start(history, keep_turns)
+            self._fold(history[recent_start:new_start])
+            recent = recent[new_start - recent_start:]
+            recent_start = new_start
+
+        request_messages = [system]
+        if self.summary_lines:
+            request_messages.append({
+                "role": "system",
+                "content": "Summary of the earlier part of the conversation:\n" + "\n".join(self.summary_lines)
+            })
+        request_messages += recent
+
+        self.last_stats = {
+            'prefix_tokens': prefix_tokens,
+            'summary_tokens': self._summary_tokens(),
+            'recent_tokens': self._tokens(recent),
+            'total_tokens': prefix_tokens + self._summary_tokens() + self._tokens(recent),
+            'recent_messages': len(recent),
+            'summarized_until': self.summarized_until,
+        }
+        return request_messages
+
+    def record_usage(self, usage):
+        # usage reported by the API, to compare with the estimate and see how much of the prompt was cached
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.last_usage = {
+            'prompt_tokens': usage.prompt_tokens,
+            'cached_tokens': getattr(details, 'cached_tokens', 0) or 0,
+            'completion_tokens': usage.completion_tokens,
+        }
+
+    def reset(self):
+        self.summary_lines = []
+        self.summarized_until = 0
+
+    def _unsummarized(self, history: list):
+        # index of the first history message not in the summary yet
+        for i, message in enumerate(history):
+            if message['seq'] >= self.summarized_until:
+                return i
+        return len(history)
+
+    def _recent_start(self, history: list, turns: int):
+        start = self._unsummarized(history)
+        user_indices = [i for i, message in enumerate(history) if message['role'] == 'user']
+        if len(user_indices) <= turns:
+            return start
+        return max(user_indices[-turns], start)
+
+    def _fold(self, messages: list):
+        for message in messages:
+            self.summary_lines.append(f"{message['role']}: {_shorten(message['content'] or '', self.summary_chars)}")
+        if messages:
+            self.summarized_until = messages[-1]['seq'] + 1
+
+        # the oldest parts of the summary go first once it outgrows its budget
+        while len(self.summary_lines) > 1 and self._summary_tokens() > self.summary_tokens:
+            self.summary_lines.pop(0)
+
+    def _compact(self, message: dict):
+        # only the fields the API takes, e.g. tables shown under a chat message stay out of the request
+        content = message['content']
+        if len(content or '') > self.message_chars:
+            content = content[:self.message_chars] + ' […]'
+        return {'role': message['role'], 'content': content}
+
+    def _summary_tokens(self):
+        return sum(estimate_tokens(line) for line in self.summary_lines)
+
+    @staticmethod
+    def _tokens(messages: list):
+        return sum(_message_tokens(message) for message in messages)
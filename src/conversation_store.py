@@ -0,0 +1,113 @@
+import json
+import sqlite3
+import threading
+import time
+
+# messages of a conversation kept in memory, older ones stay in the store until they're asked for
+WINDOW = 40
+# older messages shown per click on 'show earlier messages'
+PAGE_SIZE = 20
+
+
+class ConversationStore:
+    # Chat history of every session, appended one message at a time, so a session only keeps its latest
+    # messages in memory and its conversation comes back after the server restarts.
+    # Without a db_path it lives in memory, e.g. for the benchmarks.
+    def __init__(self, db_path: str = ':memory:'):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        if db_path != ':memory:':
+            # appends don't wait for a full sync, readers don't wait for writers
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'session_key TEXT, seq INTEGER, role TEXT, content TEXT, tables TEXT, created_at REAL, '
+                         'PRIMARY KEY (session_key, seq))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS summaries ('
+                         'session_key TEXT PRIMARY KEY, summary_lines TEXT, summarized_until INTEGER)')
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def append(self, session_key: str, message: dict):
+        # returns the seq the message got, the next one of its session, so tabs (or processes) sharing a session
+        # add to its conversation instead of overwriting each other's messages
+        with self._lock:
+            seq = self._db.execute('INSERT INTO messages SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ?, ? '
+                                   'FROM messages WHERE session_key = ? RETURNING seq',
+                                   (session_key, message['role'], message['content'],
+                                    json.dumps(message.get('tables') or []), time.time(), session_key)).fetchone()[0]
+            self._db.commit()
+        return seq
+
+    def recent(self, session_key: str, limit: int):
+        # the last `limit` messages, oldest first
+        return self._select('SELECT seq, role, content, tables FROM messages WHERE session_key = ? '
+                            'ORDER BY seq DESC LIMIT ?', (session_key, limit))
+
+    def before(self, session_key: str, seq: int, limit: int):
+        # up to `limit` messages right before seq, oldest first
+        return self._select('SELECT seq, role, content, tables FROM messages WHERE session_key = ? AND seq < ? '
+                            'ORDER BY seq DESC LIMIT ?', (session_key, seq, limit))
+
+    def save_summary(self, session_key: str, summary_lines: list, summarized_until: int):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)',
+                             (session_key, json.dumps(summary_lines), summarized_until))
+            self._db.commit()
+
+    def load_summary(self, session_key: str):
+        # (summary lines, seq of the first message not in them) kept by a ConversationContext
+        with self._lock:
+            row = self._db.execute('SELECT summary_lines, summarized_until FROM summaries WHERE session_key = ?',
+                                   (session_key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else ([], 0)
+
+    def clear(self, session_key: str):
+        with self._lock:
+            self._db.execute('DELETE FROM messages WHERE session_key = ?', (session_key,))
+            self._db.execute('DELETE FROM summaries WHERE session_key = ?', (session_key,))
+            self._db.commit()
+
+    def _select(self, query: str, parameters: tuple):
+        with self._lock:
+            rows = self._db.execute(query, parameters).fetchall()
+        return [{'seq': seq, 'role': role, 'content': content, 'tables': json.loads(tables)}
+                for seq, role, content, tables in reversed(rows)]
+
+
+class Conversation:
+    # The chat of one session: its last `window` messages in memory, everything in the store.
+    # Every message gets a seq from the store, numbered from 0 in the order they were added to the session.
+    def __init__(self, store: ConversationStore, session_key: str, window: int = WINDOW):
+        self.store = store
+        self.session_key = session_key
+        self.window = window
+        self.messages = store.recent(session_key, window)
+
+    @property
+    def has_older(self):
+        return bool(self.messages) and self.messages[0]['seq'] > 0
+
+    def append(self, role: str, content: str, tables: list = None):
+        message = {'role': role, 'content': content, 'tables': tables or []}
+        message['seq'] = self.store.append(self.session_key, message)
+        self.messages.append(message)
+        if len(self.messages) > self.window:
+            del self.messages[:len(self.messages) - self.window]
+        return message
+
+    def older(self, count: int):
+        # up to `count` messages from before the window, read from the store, oldest first
+        if count <= 0 or not self.has_older:
+            return []
+        return self.store.before(self.session_key, self.messages[0]['seq'], count)
+
+    def load_summary(self):
+        return self.store.load_summary(self.session_key)
+
+    def save_summary(self, summary_lines: list, summarized_until: int):
+        self.store.save_summary(self.session_key, summary_lines, summarized_until)
+
+    def clear(self):
+        # only the chat goes, the session keeps its login, jobs and settings
+        self.store.clear(self.session_key)
+        self.messages = []
@@ -0,0 +1,87 @@
+import json
+import logging
+import re
+import unicodedata
+
+logger = logging.getLogger('spotbot.intent_router')
+
+# Short playback commands mapped to tools that take no arguments. A prompt is routed locally only when, apart
+# from polite words around it, it is exactly one of these phrases, everything else goes to the model.
+INTENTS = {
+    'pause_playback': [
+        'pause', 'stop', 'pause it', 'stop it', 'pause the music', 'stop the music', 'pause music', 'stop music',
+        'pause playback', 'stop playback', 'stop playing', 'hold on',
+        'pauza', 'zatrzymaj', 'zatrzymaj muzykę', 'wstrzymaj', 'stop muzyka',  # pl
+        'pausa', 'para', 'detén la música', 'pausar',  # es
+        'pause la musique', 'arrête', 'arrête la musique', 'mets en pause',  # fr
+        'pausieren', 'anhalten', 'musik anhalten', 'musik stoppen', 'halt',  # de
+    ],
+    'resume_playback': [
+        'resume', 'play', 'continue', 'unpause', 'resume playback', 'resume the music', 'resume music',
+        'continue playing', 'keep playing', 'play again',
+        'wznów', 'graj', 'kontynuuj', 'wznów muzykę', 'odtwarzaj',  # pl
+        'reanudar', 'continuar', 'reproducir', 'sigue',  # es
+        'reprendre', 'reprends', 'continue la musique', 'lecture',  # fr
+        'fortsetzen', 'weiterspielen', 'abspielen', 'wiedergabe fortsetzen',  # de
+    ],
+    'switch_to_next_track': [
+        'next', 'skip', 'next track', 'next song', 'skip this', 'skip it', 'skip song', 'skip this song',
+        'skip track', 'play next', 'play next track', 'play the next song',
+        'następny', 'następna', 'następny utwór', 'następna piosenka', 'dalej', 'pomiń',  # pl
+        'siguiente', 'siguiente canción', 'salta', 'saltar',  # es
+        'suivant', 'chanson suivante', 'morceau suivant', 'passe',  # fr
+        'nächster', 'nächstes', 'nächstes lied', 'nächster titel', 'überspringen',  # de
+    ],
+    'switch_to_previous_track': [
+        'previous', 'back', 'go back', 'previous track', 'previous song', 'last song', 'play previous',
+        'play the previous song',
+        'poprzedni', 'poprzednia', 'poprzedni utwór', 'poprzednia piosenka', 'wróć', 'cofnij',  # pl
+        'anterior', 'canción anterior', 'atrás',  # es
+        'précédent', 'chanson précédente', 'morceau précédent',  # fr
+        'vorheriger', 'vorheriges', 'vorheriges lied', 'zurück',  # de
+    ],
+    'get_user_current_playback': [
+        "what's playing", 'what is playing', "what's this song", 'what is this song', 'what song is this',
+        "what's on", 'now playing', 'current song', 'current track', "what's playing now", 'what is playing now',
+        'co gra', 'co teraz gra', 'co leci', 'co to za piosenka', 'co to za utwór',  # pl
+        'qué suena', 'qué canción es esta', 'qué está sonando',  # es
+        "qu'est-ce qui joue", 'quelle est cette chanson', 'c\'est quoi cette chanson',  # fr
+        'was läuft', 'was läuft gerade', 'welches lied ist das', 'was spielt gerade',  # de
+    ],
+}
+
+# words that may surround a command without changing its meaning, e.g. 'please pause'
+FILLERS = [
+    'please', 'pls', 'can you', 'could you', 'would you', 'hey', 'ok', 'okay', 'now', 'thanks', 'thank you',
+    'spotbot', 'the music', 'proszę', 'prosze', 'możesz', 'dzięki', 'por favor', 'gracias',
+    "s'il te plaît", "s'il vous plaît", 'merci', 'bitte', 'danke',
+]
+
+
+def normalize(text: str):
+    # lowercase, without punctuation and accents, so 'What's playing?' and 'whats playing' are the same
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[’'`]", '', text)
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+
+
+class IntentRouter:
+    def __init__(self, intents: dict = None, fillers: list = None):
+        intents = intents or INTENTS
+        fillers = sorted({normalize(filler) for filler in (fillers or FILLERS)}, key=len, reverse=True)
+
+        self._phrases = {normalize(phrase): function for function, phrases in intents.items() for phrase in phrases}
+        filler_pattern = '|'.join(map(re.escape, fillers))
+        self._fillers = re.compile(rf'^(?:(?:{filler_pattern})\s+)+|(?:\s+(?:{filler_pattern}))+$')
+
+    def match(self, prompt: str):
+        # returns the name of the tool to call, or None if the prompt should go to the model
+        text = normalize(prompt)
+        function = self._phrases.get(text)
+        if function is None:
+            function = self._phrases.get(self._fillers.sub('', text))
+
+        logger.info(json.dumps({'event': 'route', 'path': 'local' if function else 'llm', 'intent': function,
+                                'prompt': prompt}, ensure_ascii=False))
+        return function
@@ -0,0 +1,129 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# finished jobs kept per owner, so the sidebar can still show (and resume) recent ones
+KEPT_JOBS = 20
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # A long tool call running in the background. The function it runs gets the job as its `job` argument:
+    # it reports progress with progress(), saves what it has done so far with save() and calls
+    # check_cancelled() between batches, so a cancelled job can be resumed from its last finished batch.
+    def __init__(self, name: str, func, arguments: dict, owner: str):
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.func = func
+        self.arguments = arguments
+        self.owner = owner
+        self.created_at = time.time()
+
+        self.state = PENDING
+        self.done = 0
+        self.total = None
+        self.status = 'waiting'
+        self.checkpoint = {}
+        self.result = None
+        self.error = None
+        # set once the result has been shown in the chat
+        self.reported = False
+
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def progress(self, done: int, total: int, status: str):
+        self.done = done
+        self.total = total
+        self.status = status
+
+    def save(self, **checkpoint):
+        self.checkpoint.update(checkpoint)
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout: float = None):
+        return self._finished.wait(timeout)
+
+    def add_done_callback(self, callback):
+        # callback(job) runs once the job finishes, in its worker thread, or right away if it already has
+        with self._lock:
+            if not self.finished:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class JobQueue:
+    # Worker threads for jobs of every session. They don't belong to any Streamlit script run,
+    # so a job keeps going when the page reruns and its result is picked up on a later run.
+    def __init__(self, max_workers: int = 4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        # owner -> jobs, oldest first
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name: str, func, arguments: dict, owner: str):
+        job = Job(name, func, arguments, owner)
+        with self._lock:
+            jobs = self._jobs.setdefault(owner, [])
+            jobs.append(job)
+            finished = [old for old in jobs if old.finished and old.reported]
+            for old in finished[:max(0, len(jobs) - KEPT_JOBS)]:
+                jobs.remove(old)
+
+        self._executor.submit(self._run, job)
+        return job
+
+    def resume(self, job: Job):
+        # runs a cancelled or failed job again, its function carries on from job.checkpoint
+        if job.state not in (CANCELLED, FAILED):
+            return
+        job.state = PENDING
+        job.error = None
+        job.reported = False
+        job._cancel.clear()
+        job._finished.clear()
+        self._executor.submit(self._run, job)
+
+    def jobs_of(self, owner: str):
+        with self._lock:
+            return list(self._jobs.get(owner, []))
+
+    def _run(self, job: Job):
+        job.state = RUNNING
+        try:
+            job.result = job.func(**job.arguments, job=job)
+            job.state = DONE
+        except JobCancelled:
+            job.state = CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            job.state = FAILED
+        finally:
+            with job._lock:
+                job._finished.set()
+                callbacks, job._callbacks = job._callbacks, []
+            for callback in callbacks:
+                callback(job)
@@ -0,0 +1,137 @@
+import difflib
+import json
+import os
+import re
+import threading
+
+from intent_router import normalize
+
+# lowest score a track found in the index needs for the lookup to skip the Search API
+MIN_CONFIDENCE = 0.8
+# how similar a misspelled word has to be to a word in the index to count as it
+FUZZY_CUTOFF = 0.8
+# words people put between a title and an artist, e.g. 'Yesterday by The Beatles'
+IGNORED_TOKENS = frozenset({'by', 'feat', 'ft'})
+
+
+def _tokens(text: str):
+    return [token for token in normalize(text).split() if token not in IGNORED_TOKENS]
+
+
+def base_title(name: str):
+    # 'Yesterday - Remastered 2009' and 'Song (feat. Someone)' are looked up by their titles alone
+    return re.split(r' - | \(| \[', name)[0] or name
+
+
+class LibraryIndex:
+    # Tracks from a user's saved tracks, top tracks and recently played, with an inverted index from
+    # normalized words of their titles and artists. Tracks found in more of those sources rank higher.
+    def __init__(self, path: str = None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        # uri -> (title tokens, artist tokens, sources the track was found in, e.g. {'saved', 'top'})
+        self._tracks = {}
+        self._postings = {}
+        # newest 'added_at' of indexed saved tracks, later refreshes fetch only tracks saved after it
+        self.saved_until = ''
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def add(self, tracks: list, source: str):
+        # tracks are Spotify track objects
+        with self._lock:
+            for track in tracks:
+                if not track or not track.get('uri'):
+                    continue
+                self._add(track['uri'], _tokens(base_title(track['name'])),
+                          [token for artist in track['artists'] for token in _tokens(artist['name'])], {source})
+
+    def lookup(self, query: str):
+        # returns the uri of the best matching track, or None if no track matches well enough
+        query_tokens = _tokens(query)
+
+        with self._lock:
+            candidates = set()
+            for token in query_tokens:
+                for close in self._close_tokens(token):
+                    candidates |= self._postings[close]
+
+            best_uri, best_rank = None, (0.0, 0)
+            for uri in candidates:
+                title, artists, sources = self._tracks[uri]
+                rank = (_score(query_tokens, title, artists), len(sources))
+                if rank > best_rank:
+                    best_uri, best_rank = uri, rank
+
+            if best_rank[0] >= MIN_CONFIDENCE:
+                self.hits += 1
+                return best_uri
+            self.misses += 1
+            return None
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {'saved_until': self.saved_until,
+                    'tracks': {uri: [title, artists, sorted(sources)]
+                               for uri, (title, artists, sources) in self._tracks.items()}}
+
+        # written next to the old index and swapped in, so a crash never leaves half of it
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(temporary_path, self.path)
+
+    def stats(self):
+        return {'tracks': len(self._tracks), 'hits': self.hits, 'misses': self.misses}
+
+    def _add(self, uri, title, artists, sources):
+        entry = self._tracks.get(uri)
+        if entry is not None:
+            sources = sources | entry[2]
+        self._tracks[uri] = (title, artists, sources)
+        for token in title + artists:
+            self._postings.setdefault(token, set()).add(uri)
+
+    def _close_tokens(self, token):
+        if token in self._postings:
+            return [token]
+        if len(token) < 4:
+            return []
+        return difflib.get_close_matches(token, self._postings.keys(), n=3, cutoff=FUZZY_CUTOFF)
+
+    def _load(self):
+        with open(self.path, 'r') as file:
+            data = json.load(file)
+        self.saved_until = data['saved_until']
+        for uri, (title, artists, sources) in data['tracks'].items():
+            self._add(uri, title, artists, set(sources))
+
+
+def _score(query_tokens: list, title: list, artists: list):
+    # every word of the query has to be in the track's title or artists, and the query has to name the
+    # whole title, so 'rhapsody' alone doesn't pick 'Bohemian Rhapsody'
+    if not query_tokens or not title:
+        return 0.0
+
+    words = title + artists
+    query_coverage = sum(_similarity(token, words) for token in query_tokens) / len(query_tokens)
+    title_coverage = sum(_similarity(token, query_tokens) for token in title) / len(title)
+    return query_coverage * title_coverage
+
+
+def _similarity(token: str, words: list):
+    if token in words:
+        return 1.0
+    if len(token) < 4:
+        return 0.0
+    ratio = max((difflib.SequenceMatcher(None, token, word).ratio() for word in words), default=0.0)
+    return ratio if ratio >= FUZZY_CUTOFF else 0.0
@@ -1,4 +1,9 @@
-from menu import Menu
-
-if __name__ == '__main__':
-    Menu()
+import time
+
+# the startup report is timed from here, imports included
+STARTED = time.perf_counter()
+
+from menu import Menu  # noqa: E402
+
+if __name__ == '__main__':
+    Menu(started=STARTED)
@@ -1,406 +1,530 @@
-import json
-
-from openai import OpenAI
-import streamlit as st
-# from rich.pretty import pprint
-
-from spotify_controller import SpotifyController
-
-
-def _read_secrets():
-    with open('secrets.json', 'r') as file:
-        return json.load(file)
-
-
-class Menu:
-    def __init__(self):
-        self.secrets = _read_secrets()
-
-        self.sp = SpotifyController(credentials=self.secrets, scopes="user-library-read,"
-                                                                     "user-read-recently-played,"
-                                                                     "user-read-playback-state,"
-                                                                     "user-modify-playback-state,"
-                                                                     "playlist-modify-public,"
-                                                                     "playlist-modify-private,"
-                                                                     "user-top-read"
-                                    )
-
-        # if user doesn't have any active devices, it will stop the app
-        if not self.sp.is_device_active():
-            st.error("You don't have any active devices. Please open Spotify on your device and refresh the page.")
-            st.stop()
-
-        self.username = self.sp.get_user_profile_name()
-
-        self.client = OpenAI(api_key=self.secrets['openai']['key'])
-
-        self.function_map = {
-            'play_track': {
-                'func': self.sp.play_track,
-                'message': lambda message: f'Playing {message}'
-            },
-            'pause_playback': {
-                'func': self.sp.pause_playback,
-                'message': lambda message: 'Stopped playback'
-            },
-            'resume_playback': {
-                'func': self.sp.resume_playback,
-                'message': lambda message: 'Resumed playback'
-            },
-            'add_to_queue': {
-                'func': self.sp.add_to_queue,
-                'message': lambda message: f'Added {message} to a queue'
-            },
-            'switch_to_next_track': {
-                'func': self.sp.switch_to_next_track,
-                'message': lambda message: f'Skipping {message}'
-            },
-            'switch_to_previous_track': {
-                'func': self.sp.switch_to_previous_track,
-                'message': lambda message: f'Switching to previous track...'
-            },
-            'get_user_current_playback': {
-                'func': self.sp.get_user_current_playback,
-                'message': lambda message: f'Currently playing: {message}'
-            },
-            'create_playlist_with_tracks': {
-                'func': self.sp.create_playlist_with_tracks,
-                'message': lambda message: f'Here\'s your playlist: {message}'
-            },
-            'get_user_top_tracks': {
-                'func': self.sp.get_user_top_tracks,
-                'message': lambda message: f'Here are your top tracks of all time:\n\n{message}'
-            },
-            'get_user_top_artists': {
-                'func': self.sp.get_user_top_artists,
-                'message': lambda message: f'Here are your top artists of all time:\n\n{message}'
-            },
-        }
-
-        self.tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "play_track",
-                    "description": "Play a song. Call this whenever you are asked to play something, "
-                                   "for example when user says 'play a Xtal by Aphex Twin', you should call this "
-                                   "function with parameter 'Xtal Aphex Twin'.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "track_name": {
-                                "type": "string",
-                                "description": "Title name and artist name of a track to play"
-                            },
-                        },
-                        "required": ["track_name"],
-                        "additionalProperties": False,
-                    },
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "pause_playback",
-                    "description": "Pause playback of a track. Call this whenever you are asked to stop or pause "
-                                   "playing something, for example when user says 'pause'"
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "resume_playback",
-                    "description": "Resume playback of a track. Call this whenever you are asked to resume or "
-                                   "start playing something (but if user asks you to play a certain song, "
-                                   "you should not call this function), for example when user says 'play' without "
-                                   "track's title",
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "switch_to_next_track",
-                    "description": "Switch current playback to a next track. For example, when users says 'play next "
-                                   "track', you should call this function.",
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "switch_to_previous_track",
-                    "description": "Switch current playback to a previous track. For example, when users says 'play"
-                                   " previous track', you should call this function",
-
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "add_to_queue",
-                    "description": "Add tracks to a playing queue. For example, when user says 'add to queue track1 and "
-                                   "track2', you should call this function with parameter ['track1', 'track2']",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "tracks": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string"
-                                },
-                                "description": "Titles of tracks alongside with it's authors, each and every one put "
-                                               "in a list"
-                            },
-                        },
-                        "required": ["tracks"],
-                        "additionalProperties": False,
-                    },
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_user_current_playback",
-                    "description": "Get current playback. For example, when users says 'what is playing', "
-                                   "you should call this function",
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "create_playlist_with_tracks",
-                    "description": "Create a playlist with tracks. Call this function when you want to create a "
-                                   "playlist that contains the tracks and it's authors based on description.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "tracks": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string"
-                                },
-                                "description": "Titles of tracks with authors names based on response."
-                            },
-                            "name": {
-                                "type": "string",
-                                "description": "Name of the playlist. If not provided, come up with a creative name "
-                                               "yourself"
-                            }
-                        },
-                        "required": ["tracks", "name"],
-                        "additionalProperties": False,
-                    },
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_user_top_tracks",
-                    "description": f"Get {self.username[0]}'s favorite tracks. Call this function when you want to get "
-                                   "top tracks, e.g. user's favorite songs. Try to get the number of tracks and pass "
-                                   "it in a parameter",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "tracks": {
-                                "type": "integer",
-                                "description": "Number of top tracks to get"
-                            }
-                        },
-                        "required": ["tracks"],
-                        "additionalProperties": False,
-                    },
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_user_top_artists",
-                    "description": f"Get {self.username[0]}'s favorite artists, performers or authors. Try to get the "
-                                   'number of them and pass it in a parameter',
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "tracks": {
-                                "type": "integer",
-                                "description": "Number of top artists to get"
-                            }
-                        },
-                        "required": ["tracks"],
-                        "additionalProperties": False,
-                    },
-                }
-            },
-        ]
-
-        self.message = ''
-        self.func_map = {}
-
-        self._draw_page()
-
-    def _draw_page(self):
-        st.set_page_config(page_title="Spotify Chatbot", page_icon="🎵", layout="wide")
-
-        openai_key = self.secrets['openai']['key']
-        with st.sidebar:
-            self._handle_sidebar()
-
-        st.title("Spotify api chatbot")
-        st.caption("A gpt-4o-mini chatbot that interacts with your Spotify account\n\n"
-                   "(please note that it's not affiliated in any way with Spotify company).")
-
-        self._handle_chat(openai_key)
-
-    def _handle_sidebar(self):
-        st.image(self.username[2], use_column_width=True)
-        st.write(f"Logged in as: [{self.username[0]}]({self.username[1]})")
-
-        st.sidebar.title("Menu")
-        if st.button('clear chat'):
-            st.session_state.clear()
-
-    def _handle_tool_call(self, tool_call):
-        called_tools_descriptions = []
-        called_tools_arguments = []
-        details = []
-
-        for item in tool_call.items():
-            # pprint(item)
-
-            arguments = json.loads(item[1]['args'])
-            function = item[1]['name']
-
-            for tool in self.tools:
-                if tool['function']['name'] == function:
-                    called_tools_descriptions.append(tool['function']['description'])
-
-            if arguments:
-                called_tools_arguments.append(str(arguments))
-
-            func = self.function_map[function]['func']
-            message_func = self.function_map[function]['message']
-
-            result = func(**arguments)
-
-            if result:
-                details.append(str(result))
-            # msg = message_func(result)
-
-        # pprint(called_tools_descriptions)
-        # pprint(called_tools_arguments)
-        # pprint(details)
-
-        stream = self._create_response_to_tool(called_tools_descriptions, called_tools_arguments, details)
-
-        for chunk in stream:
-            yield chunk
-
-    def _handle_chat(self, openai_key):
-        if "messages" not in st.session_state:
-            st.session_state["messages"] = [
-                {
-                    "role": "system",
-                    "content": f'You are a chatbot that will respond to user named {self.username[0]} with the ability '
-                               "to interact with some functionality of Spotify API. You can handle various"
-                               "commands such as playing a song, pausing or resuming playback, adding a song to a "
-                               "queue, switching to the next or previous track, getting the current playback, "
-                               "creating a playlist with tracks, and retrieving the user's top tracks or artists. "
-                               "Ensure to handle all tool calls accurately and provide clear, concise responses to "
-                               "the user. If you're not sure which tool or with what arguments to call a function, "
-                               "ask the user for more details."
-                },
-                {
-                    "role": "assistant",
-                    "content": f"Hi {self.username[0]}! What you're listening to today?"
-                }
-            ]
-
-        for msg in st.session_state.messages[1:]:
-            st.chat_message(
-                msg["role"]).write(
-                msg["content"]
-            )
-
-        if prompt := st.chat_input():
-            if not openai_key:
-                st.info("Please add your OpenAI API key to continue.")
-                st.stop()
-
-            st.session_state.messages.append({
-                "role": "user",
-                "content": prompt
-            })
-            st.chat_message("user").write(prompt)
-
-            self.stream = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=st.session_state.messages,
-                tools=self.tools,
-                stream=True
-            )
-
-            st.chat_message("assistant").write_stream(self._stream_messages)
-
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": self.message
-            })
-
-    def _stream_messages(self):
-        current_key = -1
-        for chunk in self.stream:
-            # if it's a normal message, not a tool call
-            if chunk.choices[0].delta.content is not None:
-                self.message += chunk.choices[0].delta.content
-                yield chunk.choices[0].delta.content
-
-            # if it's a tool call(s)
-            if chunk.choices[0].delta.tool_calls is not None:
-                # if there are multiple tool calls, it will group them by their index (current_key)
-                if chunk.choices[0].delta.tool_calls[0].index != current_key:
-                    current_key = chunk.choices[0].delta.tool_calls[0].index
-                    self.func_map[current_key] = {
-                        "name": chunk.choices[0].delta.tool_calls[0].function.name,
-                        "args": ""
-                    }
-                self.func_map[current_key]["args"] += chunk.choices[0].delta.tool_calls[0].function.arguments
-
-        # if there are any tool calls, it will call the function(s) and return the response
-        if self.func_map:
-            # pprint(self.func_map)
-
-            msg = self._handle_tool_call(self.func_map)
-            for chunk in msg:
-                self.message += chunk
-                yield chunk
-
-    def _create_response_to_tool(self,
-                                 called_tools_descriptions: list,
-                                 called_tools_arguments: list,
-                                 details: list):
-        prompt = (f'Function(s) called: {", ".join(called_tools_descriptions)}\n\n'
-                  f'Arguments passed: {", ".join(called_tools_arguments)}\n\n'
-                  f'Details: {", ".join(details)}')
-
-        messages = [
-            {
-                "role": "system",
-                "content": f'You are a chatbot that interacts with Spotify API. Based on description of the tool '
-                           f'call, its arguments and details listed in form:'
-                           '"Function(s) called: ...\n, Arguments passed: ...\n, Details: ...\n", '
-                           f'you should create a unique response that will be returned to user named {self.username[0]}.'
-            },
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ]
-
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            stream=True
-        )
-
-        for chunk in response:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+import time
+
+import streamlit as st
+# from rich.pretty import pprint
+
+import resources
+from conversation_context import ConversationContext
+from conversation_store import PAGE_SIZE, Conversation, ConversationStore
+from intent_router import IntentRouter
+from job_queue import CANCELLED, FAILED, PENDING, RUNNING, JobQueue
+from tool_call_assembler import ToolCallAssembler
+from tool_scheduler import ToolResult, ToolScheduler
+from tracing import TRACER
+from tools import RESPONSE_MODES, LLM, HYBRID, build_function_map, build_tools
+
+# seconds between refreshes of the now playing widget, it only reads what the playback watcher fetched
+NOW_PLAYING_REFRESH = 2
+
+
+class Menu:
+    # built on the first use, see the properties below
+    _client = None
+    _username = None
+    _tools = None
+
+    def __init__(self, started: float = None):
+        # the first run of a session is timed phase by phase from the start of the script, see the sidebar
+        self.startup = TRACER.start_turn('startup', started) if 'startup_trace' not in st.session_state else None
+
+        # the page shell and chat history are drawn first, before anything that waits on Spotify or big imports
+        st.set_page_config(page_title="Spotify Chatbot", page_icon="🎵", layout="wide")
+        st.title("Spotify api chatbot")
+        st.caption("A gpt-4o-mini chatbot that interacts with your Spotify account\n\n"
+                   "(please note that it's not affiliated in any way with Spotify company).")
+        # filled once the device check is in, if there's no active device
+        self.device_placeholder = st.empty()
+        self._mark('shell')
+
+        self.secrets = resources.get_secrets()
+        resources.get_tracer()
+        resources.finish_login()
+        resources.remember_session()
+        self.conversation = resources.get_conversation()
+        self._handle_history()
+        self._mark('history')
+
+        # every session logs in with its own Spotify account
+        if not resources.is_logged_in():
+            st.link_button('Log in with Spotify', resources.get_login_url())
+            st.stop()
+        self._mark('login')
+
+        self.sp = resources.get_spotify_controller()
+        self.sp.watch_playback()
+        # profile and devices are fetched in the background, the page shows placeholders until they're in
+        self.profile = resources.load_user_profile()
+        self.device_check = resources.check_device_active()
+
+        self.function_map = resources.get_function_map()
+        # long tool calls run as jobs of this session, outside of the script run that started them
+        self.job_queue = resources.get_job_queue()
+        self.owner = resources.get_session_key()
+        self.router = resources.get_intent_router()
+        self._mark('controller')
+
+        self.message = ''
+        # tables of listed tracks or artists shown under the reply, they don't go through the model
+        self.tables = []
+
+        self._draw_page()
+
+    @classmethod
+    def headless(cls, sp, client, username):
+        # a Menu that doesn't draw anything, to drive the chat and tool call path outside of Streamlit's page,
+        # e.g. from the benchmarks
+        menu = cls.__new__(cls)
+        menu.sp = sp
+        menu._client = client
+        menu._username = username
+        menu.function_map = build_function_map(sp)
+        menu.job_queue = JobQueue()
+        menu.owner = 'headless'
+        menu.conversation = Conversation(ConversationStore(), menu.owner)
+        menu.router = IntentRouter()
+        menu._tools = build_tools(username[0])
+        menu.message = ''
+        menu.tables = []
+        return menu
+
+    @property
+    def client(self):
+        # OpenAI's client, imported and built on the first turn that needs the model
+        if self._client is None:
+            self._client = resources.get_openai_client()
+        return self._client
+
+    @property
+    def username(self):
+        # (name, profile url, image url), waits for the background fetch if it isn't in yet
+        if self._username is None:
+            self._username = self.profile.result()
+        return self._username
+
+    @property
+    def tools(self):
+        if self._tools is None:
+            self._tools = resources.get_tools(self.username[0])
+        return self._tools
+
+    def _mark(self, phase):
+        if self.startup is not None:
+            self.startup.mark(phase)
+
+    def _draw_page(self):
+        openai_key = self.secrets['openai']['key']
+        with st.sidebar:
+            self._handle_sidebar()
+        self._mark('sidebar')
+
+        self._handle_chat(openai_key)
+        self._mark('chat')
+
+        self._show_session_checks()
+        resources.preload_openai()
+        if self.startup is not None:
+            self.startup.finish()
+            st.session_state['startup_trace'] = self.startup
+
+        with self.diagnostics:
+            self._handle_diagnostics()
+
+    def _show_session_checks(self):
+        # fills the placeholders once the background checks are in, their own time is in the 'spotify' metrics
+        name, url, image = self.username
+        with self.profile_placeholder.container():
+            st.image(image, width='stretch')
+            st.write(f"Logged in as: [{name}]({url})")
+        self._greet()
+        self._mark('profile')
+
+        device_active = self.device_check.result()
+        self._mark('devices')
+        if not device_active:
+            with self.device_placeholder.container():
+                st.error("You don't have any active devices. Please open Spotify on your device and refresh the page.")
+                if st.button('check again', key='check_devices'):
+                    resources.is_device_active(refresh=True)
+                    st.rerun()
+
+    def _handle_sidebar(self):
+        self.profile_placeholder = st.empty()
+        self.profile_placeholder.caption('Loading your profile…')
+        self._handle_now_playing()
+
+        st.sidebar.title("Menu")
+        if st.button('clear chat'):
+            # only the chat goes, the login, background jobs and settings of the session stay
+            self.conversation.clear()
+            for key in ('context', 'last_trace', 'history_pages'):
+                st.session_state.pop(key, None)
+            # the history above was already drawn
+            st.rerun()
+        st.selectbox('response mode', RESPONSE_MODES, key='response_mode',
+                     help='template answers instantly, llm lets the model phrase every answer, '
+                          'hybrid asks the model only about results like top tracks or playlists')
+        if st.button('refresh profile and devices'):
+            resources.refresh_session()
+            st.rerun()
+
+        cache_stats = self.sp.search_cache.stats()
+        st.caption(f"Search cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        if self.sp.library_index is not None:
+            index_stats = self.sp.library_index.stats()
+            st.caption(f"Library index: {index_stats['tracks']} tracks, {index_stats['hits']} hits, "
+                       f"{index_stats['misses']} misses")
+
+        scheduler_stats = self.sp.scheduler.stats()
+        st.caption(f"Spotify requests: {scheduler_stats['requests']} sent, {scheduler_stats['queue_depth']} waiting, "
+                   f"{scheduler_stats['throttled']} throttled, {scheduler_stats['coalesced']} coalesced")
+
+        self._handle_jobs()
+        # drawn at the end of the run, tables are slow to draw the first time and shouldn't hold up the chat
+        self.diagnostics = st.container()
+
+    def _handle_diagnostics(self):
+        if self.sp.last_playlist_report:
+            with st.expander('last playlist'):
+                # time spent and share of candidates let through by each stage of the playlist pipeline
+                st.dataframe(self.sp.last_playlist_report, hide_index=True)
+
+        with st.expander('latency'):
+            if 'last_trace' in st.session_state:
+                st.caption('last turn')
+                st.dataframe(st.session_state.last_trace.breakdown(), hide_index=True)
+            if 'startup_trace' in st.session_state:
+                # ms from the start of the session's first run to the end of each phase
+                st.caption('startup')
+                st.dataframe(st.session_state.startup_trace.breakdown(), hide_index=True)
+            st.caption('all sessions')
+            st.dataframe(TRACER.percentiles(), hide_index=True)
+
+        if 'context' in st.session_state:
+            with st.expander('context tokens'):
+                # estimated size of the last request, and the usage reported for it by the API
+                st.json({**st.session_state.context.last_stats, **st.session_state.context.last_usage})
+
+    @st.fragment(run_every=NOW_PLAYING_REFRESH)
+    def _handle_now_playing(self):
+        # keeps the watcher going while the page is open
+        self.sp.watch_playback()
+
+        playback, age = self.sp.now_playing()
+        if playback is None or playback.get('item') is None:
+            st.caption('Nothing is playing')
+            return
+
+        item = playback['item']
+        if item['album'].get('images'):
+            st.image(item['album']['images'][0]['url'], width='stretch')
+        st.markdown(f"**{item['name']}**  \n{', '.join(artist['name'] for artist in item['artists'])}")
+
+        progress = (playback.get('progress_ms') or 0) + (age * 1000 if playback['is_playing'] else 0)
+        progress = min(progress, item['duration_ms'])
+        st.progress(progress / item['duration_ms'],
+                    text=f"{_format_ms(progress)} / {_format_ms(item['duration_ms'])}"
+                         f"{'' if playback['is_playing'] else ' (paused)'}")
+
+    def _handle_jobs(self):
+        jobs = self.job_queue.jobs_of(self.owner)
+        if not jobs:
+            return
+
+        with st.expander('background jobs', expanded=any(job.state in (PENDING, RUNNING) for job in jobs)):
+            for job in reversed(jobs):
+                st.caption(f'{job.name.replace("_", " ")}: {job.state}, {job.error or job.status}')
+                if job.total:
+                    st.progress(job.done / job.total)
+                if job.state in (PENDING, RUNNING) and st.button('cancel', key=f'cancel_{job.id}'):
+                    job.cancel()
+                    st.rerun()
+                if job.state in (CANCELLED, FAILED) and st.button('resume', key=f'resume_{job.id}'):
+                    self.job_queue.resume(job)
+                    st.rerun()
+
+    def _report_finished_jobs(self):
+        # jobs whose turn was interrupted by a rerun post their results to the chat once they are done
+        for job in self.job_queue.jobs_of(self.owner):
+            if not job.finished or job.reported:
+                continue
+            job.reported = True
+            if job.state == CANCELLED:
+                continue
+
+            message = self._render_template(ToolResult(job.name, job.arguments, job.result, job.error))
+            if message:
+                self._greet()
+                tables = [job.result.table()] if job.result is not None and job.result.records else []
+                self._render_message(self.conversation.append("assistant", message, tables))
+
+    def _handle_tool_call(self, tool_scheduler, scheduled_calls):
+        called_tools_descriptions = []
+        called_tools_arguments = []
+        details = []
+        messages = []
+        use_llm = False
+
+        # expensive calls run as background jobs, their progress is shown until they are done, in a placeholder
+        # of its own, so it doesn't become part of the reply that is kept in the conversation
+        progress = None
+        for call in scheduled_calls:
+            for status in tool_scheduler.job_updates(call):
+                if progress is None:
+                    progress = st.empty()
+                progress.caption(status)
+        if progress is not None:
+            progress.empty()
+
+        # the calls were started while the completion was streaming, here their results are collected
+        tool_results = [tool_scheduler.result(call) for call in scheduled_calls]
+        for call in scheduled_calls:
+            if call.job is not None:
+                call.job.reported = True
+
+        for tool_result in tool_results:
+            function = tool_result.name
+            arguments = tool_result.arguments
+
+            for tool in self.tools:
+                if tool['function']['name'] == function:
+                    called_tools_descriptions.append(tool['function']['description'])
+
+            if arguments:
+                called_tools_arguments.append(str(arguments))
+
+            mode = self._response_mode(function)
+            if mode == LLM or (mode == HYBRID and self.function_map[function].get('rich')):
+                use_llm = True
+
+            result = tool_result.result
+
+            if tool_result.error:
+                details.append(f'{function} failed: {tool_result.error}')
+            elif result:
+                details.append(str(result))
+                if result.records:
+                    self.tables.append(result.table())
+
+            message = self._render_template(tool_result)
+            if message:
+                messages.append(message)
+
+        # pprint(called_tools_descriptions)
+        # pprint(called_tools_arguments)
+        # pprint(details)
+
+        # confirmations like 'Stopped playback' don't need another round trip to the model
+        if not use_llm:
+            yield "\n\n".join(messages)
+            return
+
+        stream = self._create_response_to_tool(called_tools_descriptions, called_tools_arguments, details)
+
+        started = time.perf_counter()
+        for chunk in stream:
+            yield chunk
+        self.trace.add('second_completion', time.perf_counter() - started)
+
+    def _render_template(self, tool_result):
+        if tool_result.error:
+            return f'Could not {tool_result.name.replace("_", " ")}: {tool_result.error}'
+
+        result = tool_result.result
+        if not result:
+            return None
+        return self.function_map[tool_result.name]['message'](result) if result.success else str(result)
+
+    def _handle_local_intent(self, function):
+        # answers a command recognized by the intent router without asking the model at all
+        self.trace = TRACER.start_turn()
+
+        tool_result = ToolScheduler(self.function_map, trace=self.trace).run([(function, {})])[0]
+        self.message = self._render_template(tool_result) or ''
+        yield self.message
+
+        self.trace.finish()
+        st.session_state['last_trace'] = self.trace
+
+    def _response_mode(self, function):
+        # a tool can have its own mode in the function map, otherwise the one chosen in the sidebar is used
+        return self.function_map[function].get('response_mode', st.session_state.get('response_mode', HYBRID))
+
+    def _system_message(self):
+        return {
+            "role": "system",
+            "content": f'You are a chatbot that will respond to user named {self.username[0]} with the ability '
+                       "to interact with some functionality of Spotify API. You can handle various"
+                       "commands such as playing a song, pausing or resuming playback, adding a song to a "
+                       "queue, switching to the next or previous track, getting the current playback, "
+                       "creating a playlist with tracks, and retrieving the user's top tracks or artists. "
+                       "Ensure to handle all tool calls accurately and provide clear, concise responses to "
+                       "the user. If you're not sure which tool or with what arguments to call a function, "
+                       "ask the user for more details."
+        }
+
+    def _greeting(self):
+        return f"Hi {self.username[0]}! What you're listening to today?"
+
+    def _handle_history(self):
+        # only the window of recent messages is drawn on every rerun, older ones are read from the store on request
+        self._handle_older_messages()
+        for msg in self.conversation.messages:
+            self._render_message(msg)
+
+    def _greet(self):
+        # a new chat starts with a greeting, which waits for the profile, so it goes into a placeholder
+        if self.greeting is not None and not self.conversation.messages:
+            with self.greeting.container():
+                self._render_message(self.conversation.append("assistant", self._greeting()))
+
+    def _handle_chat(self, openai_key):
+        self.greeting = st.empty() if not self.conversation.messages else None
+        self._report_finished_jobs()
+
+        if prompt := st.chat_input():
+            self._greet()
+            self.conversation.append("user", prompt)
+            st.chat_message("user").write(prompt)
+
+            # simple commands like 'pause' or 'next' don't need the model, unless their answer should come from it
+            intent = self.router.match(prompt)
+            if intent is not None and self._response_mode(intent) == LLM:
+                intent = None
+
+            if intent is not None:
+                st.chat_message("assistant").write_stream(self._handle_local_intent(intent))
+            else:
+                if not openai_key:
+                    st.info("Please add your OpenAI API key to continue.")
+                    st.stop()
+
+                self.stream = self._request_completion()
+
+                with st.chat_message("assistant"):
+                    st.write_stream(self._stream_messages)
+                    for table in self.tables:
+                        st.dataframe(table, hide_index=True)
+
+            self.conversation.append("assistant", self.message, self.tables)
+
+    def _handle_older_messages(self):
+        pages = st.session_state.get('history_pages', 0)
+        older = self.conversation.older(pages * PAGE_SIZE)
+        more = older[0]['seq'] > 0 if older else self.conversation.has_older
+        if more and st.button('show earlier messages'):
+            st.session_state['history_pages'] = pages + 1
+            st.rerun()
+        for msg in older:
+            self._render_message(msg)
+
+    @staticmethod
+    def _render_message(msg):
+        with st.chat_message(msg["role"]):
+            st.write(msg["content"])
+            for table in msg.get("tables", []):
+                st.dataframe(table, hide_index=True)
+
+    def _request_completion(self):
+        if 'context' not in st.session_state:
+            # a restored conversation carries on with the summary it had
+            st.session_state['context'] = ConversationContext()
+            st.session_state.context.summary_lines, st.session_state.context.summarized_until = \
+                self.conversation.load_summary()
+        context = st.session_state.context
+
+        self.trace = TRACER.start_turn()
+        with self.trace.span('stream_start'):
+            messages = context.build([self._system_message()] + self.conversation.messages, self.tools)
+            self.conversation.save_summary(context.summary_lines, context.summarized_until)
+            return self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                tools=self.tools,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+
+    def _stream_messages(self):
+        first_token = True
+        tool_calls_started = None
+
+        # every tool call starts running as soon as its arguments are complete, while the model is still
+        # streaming the rest of them
+        tool_scheduler = ToolScheduler(self.function_map, trace=self.trace, job_queue=self.job_queue,
+                                       owner=self.owner)
+        scheduled_calls = []
+        assembler = ToolCallAssembler(
+            lambda name, arguments: scheduled_calls.append(tool_scheduler.submit(name, arguments)))
+
+        for chunk in self.stream:
+            # the last chunk has no choices, only token usage of the whole request
+            if not chunk.choices:
+                if chunk.usage is not None:
+                    st.session_state.context.record_usage(chunk.usage)
+                continue
+
+            if first_token and (chunk.choices[0].delta.content or chunk.choices[0].delta.tool_calls):
+                self.trace.mark('first_token')
+                first_token = False
+
+            # if it's a normal message, not a tool call
+            if chunk.choices[0].delta.content is not None:
+                self.message += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+
+            # if it's a tool call(s)
+            if chunk.choices[0].delta.tool_calls is not None:
+                if tool_calls_started is None:
+                    tool_calls_started = time.perf_counter()
+                assembler.feed(chunk.choices[0].delta.tool_calls)
+
+        assembler.finish()
+        if tool_calls_started is not None:
+            self.trace.add('tool_call_assembly', time.perf_counter() - tool_calls_started)
+
+        # if there are any tool calls, it will wait for their results and return the response
+        if scheduled_calls:
+            msg = self._handle_tool_call(tool_scheduler, scheduled_calls)
+            for chunk in msg:
+                self.message += chunk
+                yield chunk
+
+        self.trace.finish()
+        st.session_state['last_trace'] = self.trace
+
+    def _create_response_to_tool(self,
+                                 called_tools_descriptions: list,
+                                 called_tools_arguments: list,
+                                 details: list):
+        prompt = (f'Function(s) called: {", ".join(called_tools_descriptions)}\n\n'
+                  f'Arguments passed: {", ".join(called_tools_arguments)}\n\n'
+                  f'Details: {", ".join(details)}')
+
+        messages = [
+            {
+                "role": "system",
+                "content": f'You are a chatbot that interacts with Spotify API. Based on description of the tool '
+                           f'call, its arguments and details listed in form:'
+                           '"Function(s) called: ...\n, Arguments passed: ...\n, Details: ...\n", '
+                           f'you should create a unique response that will be returned to user named {self.username[0]}.'
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+
+        response = self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            stream=True
+        )
+
+        for chunk in response:
+            if chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+
+
+def _format_ms(milliseconds: float):
+    seconds = int(milliseconds // 1000)
+    return f'{seconds // 60}:{seconds % 60:02d}'
@@ -0,0 +1,96 @@
+import threading
+import time
+
+
+class PlaybackState:
+    # Snapshot of current_playback and devices, so consecutive commands don't each fetch them again.
+    # A PlaybackWatcher keeps it up to date, but however long it waits between polls, commands only trust a
+    # snapshot younger than ttl; anything that just shows or reports the playback (or devices) reads the last
+    # one with cached() or latest(), however old it is.
+    def __init__(self, ttl: float = 3.0):
+        self.ttl = ttl
+        # set after every change made to the playback, so the watcher can check on it soon
+        self.mutated = threading.Event()
+
+        self._playback = None
+        self._fetched_at = 0.0
+        self._invalidated = False
+        self._devices = None
+        self._devices_fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, fetch, refresh=False):
+        if not refresh:
+            fresh, playback = self.cached()
+            if fresh:
+                return playback
+
+        playback = fetch()
+        self.set(playback)
+        return playback
+
+    def latest(self, fetch):
+        # the last snapshot, fetched only if there is none yet or a change made since may not show in it
+        with self._lock:
+            if self._fetched_at and not self._invalidated:
+                return self._playback
+        playback = fetch()
+        self.set(playback)
+        return playback
+
+    def cached(self):
+        # (is the snapshot still fresh, the snapshot)
+        with self._lock:
+            return self._is_fresh(), self._playback
+
+    def age(self):
+        # seconds since the snapshot was fetched, e.g. to move the progress of a playing track along
+        with self._lock:
+            return time.monotonic() - self._fetched_at
+
+    def set(self, playback):
+        with self._lock:
+            self._playback = playback
+            self._fetched_at = time.monotonic()
+            self._invalidated = False
+
+    def update(self, **changes):
+        # optimistic update after a successful mutation, only applied to a snapshot that's still fresh
+        with self._lock:
+            if self._playback is not None and self._is_fresh():
+                self._playback = {**self._playback, **changes}
+        self.mutated.set()
+
+    def invalidate(self):
+        with self._lock:
+            self._invalidated = True
+        self.mutated.set()
+
+    def get_devices(self, fetch, refresh=False):
+        with self._lock:
+            if not refresh and time.monotonic() - self._devices_fetched_at < self.ttl:
+                return self._devices
+
+        devices = fetch()
+        self.set_devices(devices)
+        return devices
+
+    def latest_devices(self, fetch):
+        with self._lock:
+            if self._devices is not None:
+                return self._devices
+        devices = fetch()
+        self.set_devices(devices)
+        return devices
+
+    def has_devices(self):
+        with self._lock:
+            return self._devices is not None
+
+    def set_devices(self, devices: list):
+        with self._lock:
+            self._devices = devices
+            self._devices_fetched_at = time.monotonic()
+
+    def _is_fresh(self):
+        return not self._invalidated and time.monotonic() - self._fetched_at < self.ttl
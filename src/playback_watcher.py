@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+from playback_state import PlaybackState
+
+logger = logging.getLogger('spotbot.playback_watcher')
+
+# seconds between polls right after a playback change, and for how long after it
+FAST_INTERVAL = 1.0
+FAST_WINDOW = 10.0
+# Spotify needs a moment to apply a command before it shows in current_playback
+MUTATION_DELAY = 0.5
+# longest wait between polls while a track is playing, the poll right after it ends comes sooner
+PLAYING_INTERVAL = 15.0
+# nothing playing: polls start this often and back off up to MAX_IDLE_INTERVAL
+MIN_IDLE_INTERVAL = 5.0
+MAX_IDLE_INTERVAL = 60.0
+DEVICES_INTERVAL = 30.0
+# a watcher nobody asked about for this long stops, e.g. after its browser tab was closed
+STOP_AFTER = 10 * 60
+
+
+class PlaybackWatcher:
+    # Polls current_playback and devices of one session in the background and keeps them in a PlaybackState,
+    # so the sidebar shows them without a request and commands often find a snapshot fresh enough to use.
+    def __init__(self, fetch_playback, fetch_devices, state: PlaybackState):
+        self.fetch_playback = fetch_playback
+        self.fetch_devices = fetch_devices
+        self.state = state
+
+        self._last_touched = time.monotonic()
+        self._mutated_at = 0.0
+        self._idle_interval = MIN_IDLE_INTERVAL
+        self._thread = threading.Thread(target=self._run, daemon=True, name='playback-watcher')
+
+    @property
+    def alive(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def touch(self):
+        self._last_touched = time.monotonic()
+
+    def _run(self):
+        devices_due = 0.0
+        while time.monotonic() - self._last_touched < STOP_AFTER:
+            interval = self._idle_interval
+            try:
+                playback = self.fetch_playback()
+                interval = self._next_interval(playback)
+                self.state.set(playback)
+
+                if playback is None or time.monotonic() >= devices_due:
+                    self.state.set_devices(self.fetch_devices())
+                    devices_due = time.monotonic() + DEVICES_INTERVAL
+            except Exception as e:
+                logger.warning(f'Could not poll the playback: {e}')
+
+            if self.state.mutated.wait(interval):
+                self.state.mutated.clear()
+                self._mutated_at = time.monotonic()
+                self._idle_interval = MIN_IDLE_INTERVAL
+                devices_due = 0.0
+                time.sleep(MUTATION_DELAY)
+
+    def _next_interval(self, playback):
+        if playback is None or not playback.get('is_playing') or playback.get('item') is None:
+            interval = self._idle_interval
+            self._idle_interval = min(self._idle_interval * 2, MAX_IDLE_INTERVAL)
+        else:
+            self._idle_interval = MIN_IDLE_INTERVAL
+            # poll again right after the track ends, to catch the next one
+            left = (playback['item']['duration_ms'] - (playback.get('progress_ms') or 0)) / 1000
+            interval = max(FAST_INTERVAL, min(PLAYING_INTERVAL, left + MUTATION_DELAY))
+
+        if time.monotonic() - self._mutated_at < FAST_WINDOW:
+            interval = min(interval, FAST_INTERVAL)
+        return interval
@@ -0,0 +1,228 @@
+import asyncio
+import difflib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from intent_router import normalize
+from library_index import LibraryIndex, base_title
+from search_cache import SearchCache, NOT_CACHED
+from tracing import TRACER
+
+logger = logging.getLogger('spotbot.playlist_pipeline')
+
+# the model is asked for this many times more candidates than the playlist should have, the extra ones
+# take the place of candidates that can't be found or turn out to be duplicates
+OVERSAMPLING = 1.5
+# search results scored for every candidate
+TOP_K = 5
+# lowest score a search result needs to stand for a candidate, and how much the title weighs against the artist
+MIN_SCORE = 0.7
+TITLE_WEIGHT = 0.6
+MAX_WORKERS = 8
+# picks of the pipeline are cached under their own keys, apart from the plain top result cached by other searches
+SCORED_KEY_PREFIX = 'scored:'
+
+STAGES = ('resolve', 'score', 'dedupe', 'fill')
+
+
+def split_candidate(candidate: str):
+    # 'Xtal by Aphex Twin' -> ('Xtal', 'Aphex Twin'), a candidate without an artist has '' as one
+    if ' by ' in candidate:
+        title, artist = candidate.rsplit(' by ', 1)
+        return title, artist
+    return candidate, ''
+
+
+def _ratio(a: str, b: str):
+    return difflib.SequenceMatcher(None, normalize(a), normalize(b)).ratio()
+
+
+def score(candidate: str, track: dict):
+    # how well a search result matches the candidate, from 0 to 1
+    name = track['name']
+    artists = [artist['name'] for artist in track.get('artists') or []]
+    title, artist = split_candidate(candidate)
+    if not artist and ' - ' in candidate:
+        # 'Aphex Twin - Xtal' or 'Xtal - Aphex Twin', whichever fits better
+        first, second = candidate.split(' - ', 1)
+        return max(score(f'{first} by {second}', track), score(f'{second} by {first}', track))
+
+    title_score = max(_ratio(title, name), _ratio(title, base_title(name)))
+    if not artist:
+        # 'Xtal Aphex Twin' names both without saying where one ends
+        return max(title_score, *(_ratio(candidate, f'{base_title(name)} {other}') for other in artists or ['']))
+    artist_score = max((_ratio(artist, other) for other in artists), default=0.0)
+    # weighted geometric mean, so a cover of the right title by someone else doesn't pass on the title alone
+    return title_score ** TITLE_WEIGHT * artist_score ** (1 - TITLE_WEIGHT)
+
+
+def best_match(candidate: str, items: list):
+    # uri of the search result that scores best for the candidate, None if none scores MIN_SCORE
+    if not items:
+        return None
+    scores = [score(candidate, track) for track in items]
+    best = max(scores)
+    return items[scores.index(best)]['uri'] if best >= MIN_SCORE else None
+
+
+class PlaylistPipeline:
+    # Fills a playlist of `size` distinct tracks from candidates the model came up with, best first.
+    # Candidates go through in batches of just as many as the playlist still needs:
+    #   resolve - the library index and earlier picks in the search cache, otherwise a search for TOP_K results,
+    #             concurrently
+    #   score   - the search result most like the candidate's title and artist, if it scores MIN_SCORE
+    #   dedupe  - tracks already in the playlist (or earlier in the batch) are dropped
+    #   fill    - the rest is added to the playlist
+    # so extra candidates are only searched for when earlier ones didn't make it.
+    def __init__(self, search, add, size: int, library_index: LibraryIndex = None, search_cache: SearchCache = None,
+                 batch_size: int = None, max_workers: int = MAX_WORKERS):
+        # search(query) returns up to TOP_K track objects, add(uris) puts tracks into the playlist,
+        # batch_size caps how many candidates are resolved at once, e.g. between checkpoints of a job
+        self.search = search
+        self.add = add
+        self.size = size
+        self.library_index = library_index
+        self.search_cache = search_cache
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+
+        # stage -> seconds spent, items that came in and items that made it through
+        self.stats = {stage: {'seconds': 0.0, 'in': 0, 'out': 0} for stage in STAGES}
+        # candidates the library index or search cache knew, without a search
+        self.known = 0
+
+    def run(self, candidates: list, job=None):
+        # returns (uris added, candidates that couldn't be found), a job carries on from its checkpoint
+        checkpoint = job.checkpoint if job is not None else {}
+        done = checkpoint.get('done', 0)
+        uris = list(checkpoint.get('uris', []))
+        missing = list(checkpoint.get('missing', []))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='playlist') as executor:
+            while len(uris) < self.size and done < len(candidates):
+                if job is not None:
+                    job.check_cancelled()
+                batch = self._next_batch(candidates, done, uris)
+
+                started = time.perf_counter()
+                resolved = list(executor.map(self._resolve, batch))
+                new = self._select(batch, resolved, started, uris, missing)
+
+                started = time.perf_counter()
+                if new:
+                    self.add(new)
+                uris += new
+                self._record('fill', started, len(new), len(new))
+
+                done += len(batch)
+                if job is not None:
+                    job.save(done=done, uris=uris, missing=missing)
+                    job.progress(len(uris), self.size, f'added {len(uris)}/{self.size} tracks')
+
+        self._finish(done, uris)
+        return uris, missing
+
+    def report(self):
+        # one row per stage, e.g. for the sidebar
+        rows = []
+        for stage, stats in self.stats.items():
+            row = {'stage': stage, 'ms': round(stats['seconds'] * 1000, 1), 'in': stats['in'], 'out': stats['out'],
+                   'hit_rate': round(stats['out'] / stats['in'], 2) if stats['in'] else None}
+            if stage == 'resolve':
+                row['without_search'] = self.known
+            rows.append(row)
+        return rows
+
+    def _next_batch(self, candidates: list, done: int, uris: list):
+        return candidates[done:done + min(self.batch_size or self.size, self.size - len(uris))]
+
+    def _resolve(self, candidate: str):
+        # (uri, None) for a candidate known without searching, otherwise (None, search results)
+        known = self._lookup(candidate)
+        return known if known is not None else (None, self.search(candidate))
+
+    def _lookup(self, candidate: str):
+        # (uri, None) if the library index or an earlier pick knows the candidate, None if it has to be searched for
+        if self.library_index is not None:
+            uri = self.library_index.lookup(candidate)
+            if uri is not None:
+                return uri, None
+
+        if self.search_cache is not None:
+            cached = self.search_cache.get(SCORED_KEY_PREFIX + candidate)
+            if cached is not NOT_CACHED:
+                return cached, None
+        return None
+
+    def _select(self, batch: list, resolved: list, started: float, uris: list, missing: list):
+        # the score and dedupe stages of a resolved batch, returns the uris it adds to the playlist and adds
+        # candidates that couldn't be found to missing
+        self._record('resolve', started, len(batch), sum(1 for uri, items in resolved if uri or items))
+        self.known += sum(1 for _, items in resolved if items is None)
+
+        started = time.perf_counter()
+        picks = [self._pick(candidate, uri, items) for candidate, (uri, items) in zip(batch, resolved)]
+        missing += [candidate for candidate, pick in zip(batch, picks) if pick is None]
+        found = [pick for pick in picks if pick is not None]
+        self._record('score', started, len(batch), len(found))
+
+        started = time.perf_counter()
+        new = list(dict.fromkeys(uri for uri in found if uri not in uris))
+        self._record('dedupe', started, len(found), len(new))
+        return new[:self.size - len(uris)]
+
+    def _pick(self, candidate: str, uri, items):
+        if items is None:
+            return uri
+
+        uri = best_match(candidate, items)
+        # a candidate nothing scored MIN_SCORE for is remembered too, for as long as the cache keeps misses
+        if self.search_cache is not None:
+            self.search_cache.set(SCORED_KEY_PREFIX + candidate, uri)
+        return uri
+
+    def _record(self, stage: str, started: float, count_in: int, count_out: int):
+        stats = self.stats[stage]
+        stats['seconds'] += time.perf_counter() - started
+        stats['in'] += count_in
+        stats['out'] += count_out
+
+    def _finish(self, done: int, uris: list):
+        for stage, stats in self.stats.items():
+            TRACER.record(f'playlist.{stage}', stats['seconds'])
+        logger.info(json.dumps({'event': 'playlist', 'size': self.size, 'added': len(uris),
+                                'candidates': done, 'stages': self.report()}))
+
+
+class AsyncPlaylistPipeline(PlaylistPipeline):
+    # The same stages on an event loop, for AsyncSpotifyController: search and add are coroutine functions and
+    # the candidates of a batch are searched concurrently, at most max_workers at a time.
+    async def run(self, candidates: list):
+        uris, missing, done = [], [], 0
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def resolve(candidate):
+            known = self._lookup(candidate)
+            if known is not None:
+                return known
+            async with semaphore:
+                return None, await self.search(candidate)
+
+        while len(uris) < self.size and done < len(candidates):
+            batch = self._next_batch(candidates, done, uris)
+
+            started = time.perf_counter()
+            resolved = await asyncio.gather(*map(resolve, batch))
+            new = self._select(batch, resolved, started, uris, missing)
+
+            started = time.perf_counter()
+            if new:
+                await self.add(new)
+            uris += new
+            self._record('fill', started, len(new), len(new))
+            done += len(batch)
+
+        self._finish(done, uris)
+        return uris, missing
@@ -0,0 +1,63 @@
+# compact items of tool results, rendered one way for the chat's tables and another, shorter way for the model
+
+# characters of listed items a tool result may put into a prompt, the rest is counted in a '+N more' line
+MODEL_BUDGET = 1200
+
+
+class TrackRecord:
+    __slots__ = ('id', 'name', 'artist', 'uri')
+
+    def __init__(self, id: str, name: str, artist: str, uri: str):
+        self.id = id
+        self.name = name
+        self.artist = artist
+        self.uri = uri
+
+    @classmethod
+    def from_track(cls, track: dict):
+        artists = track.get('artists') or [{'name': ''}]
+        return cls(track['id'], track['name'], artists[0]['name'], track['uri'])
+
+    def to_text(self):
+        return f'{self.name} by {self.artist}'
+
+    def to_row(self):
+        return {'track': self.name, 'artist': self.artist}
+
+
+class ArtistRecord:
+    __slots__ = ('id', 'name', 'uri')
+
+    def __init__(self, id: str, name: str, uri: str):
+        self.id = id
+        self.name = name
+        self.uri = uri
+
+    @classmethod
+    def from_artist(cls, artist: dict):
+        return cls(artist['id'], artist['name'], artist['uri'])
+
+    def to_text(self):
+        return self.name
+
+    def to_row(self):
+        return {'artist': self.name}
+
+
+def render_for_model(records: list, budget: int = MODEL_BUDGET):
+    # numbered lines until the budget runs out, e.g. '1. Xtal by Aphex Twin' ... '+62 more'
+    lines = []
+    used = 0
+    for number, record in enumerate(records, start=1):
+        line = f'{number}. {record.to_text()}'
+        if used + len(line) > budget:
+            lines.append(f'+{len(records) - number + 1} more')
+            break
+        lines.append(line)
+        used += len(line) + 1
+    return '\n'.join(lines)
+
+
+def render_for_ui(records: list):
+    # rows of a table shown in the chat, with every record
+    return [{'#': number, **record.to_row()} for number, record in enumerate(records, start=1)]
@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import spotipy
+
+# priorities of Spotify requests, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+# spotipy methods that only read data, identical calls of those made at the same time share one request
+COALESCED_METHODS = frozenset({
+    'me', 'search', 'current_playback', 'currently_playing', 'devices', 'queue', 'current_user_top_tracks',
+    'current_user_top_artists', 'current_user_saved_tracks', 'current_user_recently_played',
+})
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def wait_time(self):
+        # seconds until a token is available, 0 if one is available now
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self._tokens -= 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RequestScheduler:
+    # Every Spotify request goes through here: it waits for a token from the app-wide bucket and from
+    # the bucket of the user it's made for, waiting requests are let through by priority, requests answered
+    # with 429 are retried after Retry-After (plus some jitter) and identical reads in flight are made once.
+    def __init__(self, app_rate: float = 50, app_burst: float = 100, user_rate: float = 20, user_burst: float = 60,
+                 max_retries: int = 4):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_retries = max_retries
+
+        self._app_bucket = TokenBucket(app_rate, app_burst)
+        self._user_buckets = {}
+        # (priority, sequence number, user) of requests waiting for a token
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        # Spotify's Retry-After applies to the whole app, so nobody is let through until it passes
+        self._blocked_until = 0.0
+
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.max_queue_depth = 0
+
+    def call(self, user: str, priority: int, func, *args, coalesce_key=None, **kwargs):
+        if coalesce_key is None:
+            return self._call(user, priority, func, args, kwargs)
+
+        with self._in_flight_lock:
+            future = self._in_flight.get(coalesce_key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self._in_flight[coalesce_key] = Future()
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(self._call(user, priority, func, args, kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[coalesce_key]
+
+        return future.result()
+
+    def stats(self):
+        with self._condition:
+            queue_depth = len(self._waiting)
+        return {
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'coalesced': self.coalesced,
+        }
+
+    def _call(self, user, priority, func, args, kwargs):
+        attempt = 0
+        while True:
+            self._acquire(user, priority)
+            try:
+                return func(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                if e.http_status != 429 or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self._throttle(e, attempt)
+
+    def _throttle(self, error, attempt):
+        retry_after = (error.headers or {}).get('Retry-After')
+        delay = float(retry_after) if retry_after else 2 ** (attempt - 1)
+        # jitter spreads retries of requests throttled at the same time
+        delay += random.uniform(0, min(1.0, delay / 2))
+
+        with self._condition:
+            self.throttled += 1
+            self.retries += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._condition.notify_all()
+
+    def _acquire(self, user, priority):
+        entry = (priority, next(self._sequence), user)
+
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+
+            while True:
+                wait = self._wait_time(entry)
+                if wait == 0:
+                    break
+                self._condition.wait(wait)
+
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._app_bucket.take()
+            self._user_bucket(user).take()
+            self.requests += 1
+            self._condition.notify_all()
+
+    def _wait_time(self, entry):
+        # the first waiting request (by priority) whose user has a token left goes next,
+        # so one user's burst doesn't hold up everyone else
+        blocked = max(self._blocked_until - time.monotonic(), self._app_bucket.wait_time())
+        if blocked > 0:
+            return blocked
+
+        next_ready = None
+        shortest = None
+        for waiting in sorted(self._waiting):
+            user_wait = self._user_bucket(waiting[2]).wait_time()
+            if user_wait == 0:
+                next_ready = waiting
+                break
+            shortest = user_wait if shortest is None else min(shortest, user_wait)
+
+        if next_ready == entry:
+            return 0
+        if next_ready is not None:
+            # someone else goes first, they will wake us up
+            return 0.05
+        return shortest
+
+    def _user_bucket(self, user):
+        bucket = self._user_buckets.get(user)
+        if bucket is None:
+            bucket = self._user_buckets[user] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+
+class ScheduledSpotify:
+    # spotipy.Spotify whose API calls all go through a RequestScheduler, on behalf of one user
+    def __init__(self, client: spotipy.Spotify, scheduler: RequestScheduler, user: str, priority: int = INTERACTIVE):
+        self.client = client
+        self.scheduler = scheduler
+        self.user = user
+        self.priority = priority
+
+    def with_priority(self, priority: int):
+        return ScheduledSpotify(self.client, self.scheduler, self.user, priority)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def scheduled(*args, **kwargs):
+            coalesce_key = None
+            if name in COALESCED_METHODS:
+                coalesce_key = (self.user, name, repr(args), repr(sorted(kwargs.items())))
+            return self.scheduler.call(self.user, self.priority, attribute, *args, coalesce_key=coalesce_key,
+                                       **kwargs)
+
+        return scheduled
@@ -0,0 +1,293 @@
+import importlib
+import json
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import streamlit as st
+
+from conversation_store import Conversation, ConversationStore
+from intent_router import IntentRouter
+from job_queue import JobQueue
+from search_cache import SearchCache
+from tools import RESPONSE_MODES, build_function_map, build_tools
+from top_items import TopItemsCache
+from tracing import TRACER
+
+SCOPES = ("user-library-read,"
+          "user-read-recently-played,"
+          "user-read-playback-state,"
+          "user-modify-playback-state,"
+          "playlist-modify-public,"
+          "playlist-modify-private,"
+          "user-top-read")
+
+SEARCH_CACHE_PATH = 'search_cache.sqlite'
+LIBRARY_INDEX_DIR = 'library_index'
+CONVERSATION_STORE_PATH = 'conversations.sqlite'
+
+# the browser keeps its session key in this cookie for a year
+SESSION_COOKIE = 'spotbot_session'
+SESSION_COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+# a login has to come back from Spotify within this many seconds
+LOGIN_TIMEOUT = 10 * 60
+
+# Streamlit reruns the whole script on every interaction, so everything expensive lives here:
+# clients, caches and the HTTP connection pool are kept per process with st.cache_resource, while
+# everything tied to a Spotify account (its token, controller, profile, device status) is kept per
+# session in st.session_state, so several people can use one server at the same time.
+# openai and spotipy (and everything built on them) take a while to import, so they are imported on first
+# use, after the page has been drawn
+
+
+@st.cache_resource
+def get_secrets():
+    with open('secrets.json', 'r') as file:
+        return json.load(file)
+
+
+# optional "metrics" section of secrets.json, e.g. {"log_file": "turns.jsonl", "prometheus_file": "metrics.prom",
+# "prometheus_port": 9108}
+@st.cache_resource
+def get_tracer():
+    TRACER.configure(**get_secrets().get('metrics', {}))
+    return TRACER
+
+
+# cached searches outlive Streamlit reruns, the SQLite tier keeps them across restarts
+@st.cache_resource
+def get_search_cache():
+    return SearchCache(db_path=SEARCH_CACHE_PATH)
+
+
+@st.cache_resource
+def get_top_items_cache():
+    return TopItemsCache()
+
+
+@st.cache_resource
+def get_request_scheduler():
+    from request_scheduler import RequestScheduler
+
+    scheduler = RequestScheduler()
+    get_tracer().register_gauges('spotify_requests', scheduler.stats)
+    return scheduler
+
+
+@st.cache_resource
+def get_http_session():
+    # one connection pool for the Spotify clients and OAuth managers of every session
+    from spotify_controller import build_session
+
+    return build_session(pool_size=64)
+
+
+# optional "token_store" section of secrets.json, e.g. {"type": "sqlite", "path": "tokens.sqlite"},
+# tokens are kept in memory by default and sessions have to log in again after a restart
+@st.cache_resource
+def get_token_store():
+    from token_store import MemoryTokenStore, SQLiteTokenStore
+
+    config = get_secrets().get('token_store', {})
+    if config.get('type') == 'sqlite':
+        return SQLiteTokenStore(config.get('path', 'tokens.sqlite'))
+    return MemoryTokenStore()
+
+
+@st.cache_resource
+def get_token_refresher():
+    from token_store import TokenRefresher
+
+    return TokenRefresher(get_token_store(), make_auth_manager).start()
+
+
+def make_auth_manager(session_key: str):
+    from spotipy.oauth2 import SpotifyOAuth
+    from token_store import SessionCacheHandler
+
+    spotify = get_secrets()['spotify']
+    return SpotifyOAuth(scope=SCOPES,
+                        client_id=spotify['client_id'],
+                        client_secret=spotify['client_secret'],
+                        redirect_uri=spotify['redirect_uri'],
+                        open_browser=False,
+                        cache_handler=SessionCacheHandler(get_token_store(), session_key),
+                        requests_session=get_http_session())
+
+
+def get_session_key():
+    # identifies whose token and chat a session uses; it's random and kept in a cookie, so reloading the page
+    # doesn't log the user out, and it's never part of the URL, where it would be shared along with a link
+    if 'session_key' not in st.session_state:
+        cookie = str(st.context.cookies.get(SESSION_COOKIE) or '')
+        st.session_state['session_key'] = (cookie if re.fullmatch(r'[\w-]{43}', cookie)
+                                           else secrets.token_urlsafe(32))
+    return st.session_state['session_key']
+
+
+def remember_session():
+    # Streamlit can't set cookies on its responses, so the page sets it
+    session_key = get_session_key()
+    if st.context.cookies.get(SESSION_COOKIE) != session_key:
+        st.html(f'<script>document.cookie = "{SESSION_COOKIE}={session_key}; path=/; '
+                f'max-age={SESSION_COOKIE_MAX_AGE}; SameSite=Lax" '
+                f'+ (location.protocol === "https:" ? "; Secure" : "");</script>',
+                unsafe_allow_javascript=True)
+
+
+@st.cache_resource
+def get_pending_logins():
+    # one-time OAuth state of every login that was started -> (key of the session that started it, when)
+    return {}, threading.Lock()
+
+
+def finish_login():
+    # Spotify redirects back with ?code=...&state=... after the user logs in; the state has to be one that
+    # get_login_url handed out to this very session, and only once, so a login link or callback made by someone
+    # else can't put their account into this session or this user's token into theirs
+    params = st.query_params
+    if 'code' in params and 'state' in params:
+        code, state = params['code'], params['state']
+        st.query_params.clear()
+        pending, lock = get_pending_logins()
+        with lock:
+            login = pending.pop(state, None)
+        session_key = get_session_key()
+        if login is None or login[0] != session_key or time.time() - login[1] > LOGIN_TIMEOUT:
+            return
+        make_auth_manager(session_key).get_access_token(code, as_dict=False, check_cache=False)
+
+
+def is_logged_in():
+    finish_login()
+    # a token spotipy can't use (e.g. missing a scope) would make it ask for a login on the server's console
+    session_key = get_session_key()
+    return make_auth_manager(session_key).validate_token(get_token_store().get(session_key)) is not None
+
+
+def get_login_url():
+    # every login gets a state of its own, logins that never came back are forgotten after LOGIN_TIMEOUT
+    session_key = get_session_key()
+    state = secrets.token_urlsafe(16)
+    pending, lock = get_pending_logins()
+    with lock:
+        now = time.time()
+        for expired in [other for other, (_, started) in pending.items() if now - started > LOGIN_TIMEOUT]:
+            del pending[expired]
+        pending[state] = (session_key, now)
+    return make_auth_manager(session_key).get_authorize_url(state)
+
+
+def get_spotify_controller():
+    if 'spotify_controller' not in st.session_state:
+        import spotipy
+        from spotify_controller import SpotifyController
+
+        session_key = get_session_key()
+        client = spotipy.Spotify(auth_manager=make_auth_manager(session_key), requests_session=get_http_session())
+        # optional "api_url" in the "spotify" section of secrets.json points the client somewhere else than
+        # the Web API, e.g. at the fake server of bench/load_test.py
+        client.prefix = get_secrets()['spotify'].get('api_url', client.prefix)
+        st.session_state['spotify_controller'] = SpotifyController(
+            credentials=get_secrets(), scopes=SCOPES, search_cache=get_search_cache(),
+            top_items_cache=get_top_items_cache(), client=client, scheduler=get_request_scheduler(), user=session_key)
+    # keeps the token refreshed and the library index up to date while the session is in use
+    get_token_refresher().touch(get_session_key())
+    st.session_state['spotify_controller'].start_library_index(LIBRARY_INDEX_DIR)
+    return st.session_state['spotify_controller']
+
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+
+@st.cache_resource
+def get_conversation_store():
+    return ConversationStore(CONVERSATION_STORE_PATH)
+
+
+def get_conversation():
+    # the session key stays in a cookie, so a reload or a restarted server picks the chat up from the store
+    if 'conversation' not in st.session_state:
+        st.session_state['conversation'] = Conversation(get_conversation_store(), get_session_key())
+    return st.session_state['conversation']
+
+
+@st.cache_resource
+def get_openai_client():
+    from openai import OpenAI
+
+    return OpenAI(api_key=get_secrets()['openai']['key'])
+
+
+@st.cache_resource
+def preload_openai():
+    # imports openai in the background once the page is up, so the first turn that needs the model doesn't wait
+    thread = threading.Thread(target=importlib.import_module, args=('openai',), daemon=True, name='preload-openai')
+    thread.start()
+    return thread
+
+
+@st.cache_resource
+def get_background_executor():
+    # profile and device checks run here, so the page doesn't wait on Spotify to show
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix='session-check')
+
+
+# optional "response_modes" section of secrets.json gives tools a response mode of their own, whatever is chosen
+# in the sidebar, e.g. {"get_user_top_tracks": "llm", "play_track": "template"}
+def get_function_map():
+    if 'function_map' not in st.session_state:
+        function_map = build_function_map(get_spotify_controller())
+        for name, mode in get_secrets().get('response_modes', {}).items():
+            if name not in function_map or mode not in RESPONSE_MODES:
+                raise ValueError(f'Invalid response mode {mode!r} for tool {name!r} in secrets.json')
+            function_map[name]['response_mode'] = mode
+        st.session_state['function_map'] = function_map
+    return st.session_state['function_map']
+
+
+@st.cache_resource
+def get_tools(username: str):
+    return build_tools(username)
+
+
+@st.cache_resource
+def get_intent_router():
+    return IntentRouter()
+
+
+def load_user_profile(refresh=False):
+    # a Future of (name, profile url, image url), fetched once per session
+    if refresh or 'user_profile' not in st.session_state:
+        st.session_state['user_profile'] = get_background_executor().submit(
+            get_spotify_controller().get_user_profile_name)
+    return st.session_state['user_profile']
+
+
+def get_user_profile(refresh=False):
+    return load_user_profile(refresh).result()
+
+
+def check_device_active(refresh=False):
+    # a Future of whether the user has an active device; the playback watcher keeps the devices up to date, so
+    # once it has polled them this is answered from its snapshot right away, a request is only made before that
+    # or when asked to refresh
+    controller = get_spotify_controller()
+    if not refresh and controller.knows_devices():
+        future = Future()
+        future.set_result(controller.is_device_active())
+        return future
+    return get_background_executor().submit(controller.is_device_active, refresh=refresh)
+
+
+def is_device_active(refresh=False):
+    return check_device_active(refresh).result()
+
+
+def refresh_session():
+    load_user_profile(refresh=True)
+    check_device_active(refresh=True)
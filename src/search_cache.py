@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# returned by SearchCache.get when the query has never been cached (or has expired),
+# as None is a valid cached value meaning "search returned nothing"
+NOT_CACHED = object()
+
+
+def normalize_query(query: str):
+    return ' '.join(query.casefold().split())
+
+
+class SearchCache:
+    def __init__(self,
+                 max_entries: int = 2048,
+                 ttl: float = 7 * 24 * 3600,
+                 negative_ttl: float = 6 * 3600,
+                 db_path: str = None,
+                 max_db_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_db_entries = max_db_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._writes = 0
+
+        # query -> (uri or None, expires_at), ordered from least to most recently used
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS search_cache ('
+                             'query TEXT PRIMARY KEY, uri TEXT, expires_at REAL, accessed_at REAL)')
+            self._db.execute('DELETE FROM search_cache WHERE expires_at < ?', (time.time(),))
+            self._db.commit()
+
+    def get(self, query: str):
+        key = normalize_query(query)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute('SELECT uri, expires_at FROM search_cache WHERE query = ? AND expires_at > ?',
+                                       (key, now)).fetchone()
+                if row is not None:
+                    self._db.execute('UPDATE search_cache SET accessed_at = ? WHERE query = ?', (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return NOT_CACHED
+
+    def set(self, query: str, uri):
+        key = normalize_query(query)
+        now = time.time()
+        # queries without a match are cached too, but for a shorter time, as the catalog may change
+        expires_at = now + (self.ttl if uri is not None else self.negative_ttl)
+
+        with self._lock:
+            self._remember(key, uri, expires_at)
+
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)',
+                                 (key, uri, expires_at, now))
+                self._writes += 1
+                # counting rows isn't free, so the disk tier is trimmed only every so often
+                if self._writes % 256 == 0:
+                    self._evict_disk()
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM search_cache')
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'entries': len(self._memory),
+            }
+
+    def _remember(self, key, uri, expires_at):
+        self._memory[key] = (uri, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        count = self._db.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0]
+        if count > self.max_db_entries:
+            self._db.execute('DELETE FROM search_cache WHERE query IN '
+                             '(SELECT query FROM search_cache ORDER BY accessed_at LIMIT ?)',
+                             (count - self.max_db_entries,))
@@ -1,172 +1,467 @@
-
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-
-
-class SpotifyController:
-    def __init__(self, credentials, scopes: str):
-        try:
-            self.sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scopes,
-                                                                client_id=credentials['spotify']['client_id'],
-                                                                client_secret=credentials['spotify'][
-                                                                    'client_secret'],
-                                                                redirect_uri=credentials['spotify'][
-                                                                    'redirect_uri']))
-        except Exception as e:
-            print(f"Error initializing SpotifyController: \n{e}")
-
-
-
-    def _get_current_playback(self):
-        return self.sp.current_playback()
-
-    def _create_playlist(self, name: str):
-        return self.sp.user_playlist_create(self.sp.me()['id'], name)
-
-    def get_user_profile_name(self):
-        user = self.sp.me()
-        return user['display_name'], user['external_urls']['spotify'], user['images'][0]['url']
-
-    def _fetch_top_tracks(self, tracks=50):
-        iterations = tracks // 50
-        last_iteration = tracks % 50
-
-        top_tracks = []
-
-        for i in range(iterations):
-            top_tracks += self.sp.current_user_top_tracks(limit=50, offset=i * 50, time_range='long_term')['items']
-
-        if last_iteration:
-            top_tracks += self.sp.current_user_top_tracks(limit=last_iteration, offset=iterations * 50,
-                                                          time_range='long_term')['items']
-
-        return top_tracks
-
-    def _fetch_top_artists(self, artists=50):
-        iterations = artists // 50
-        last_iteration = artists % 50
-
-        top_artists = []
-
-        for i in range(iterations):
-            top_artists += self.sp.current_user_top_artists(limit=50, offset=i * 50, time_range='long_term')['items']
-
-        if last_iteration:
-            top_artists += self.sp.current_user_top_artists(limit=last_iteration, offset=iterations * 50,
-                                                            time_range='long_term')['items']
-
-        return top_artists
-
-    def _search_track(self, query: str):
-        return self.sp.search(query, limit=1)['tracks']['items'][0]['uri']
-
-    def is_device_active(self):
-        for device in self.sp.devices()['devices']:
-            if device['is_active']:
-                return True
-        return False
-
-    def play_track(self, track_uri=None, track_name=None):
-        if track_uri:
-            self.sp.add_to_queue(track_uri)
-            self.sp.next_track()
-            # self.sp.start_playback(uris=[track_uri])
-        if track_name:
-            track = self._search_track(track_name)
-
-            # sp.start_playback plays the given track, but unfortunately erases a queue, so it's better to use
-            # add_to_queue and next_track
-
-            self.sp.add_to_queue(track)
-            self.sp.next_track()
-
-            # self.sp.start_playback(uris=[track])
-        else:
-            return None
-        return Response(track_name)
-
-    def pause_playback(self):
-        if self.sp.current_playback()['is_playing']:
-            self.sp.pause_playback()
-            return Response('Stopped playback')
-        else:
-            return Response('Playback is already paused')
-
-    def resume_playback(self):
-        if not self.sp.current_playback()['is_playing']:
-            self.sp.start_playback()
-            return Response('Resumed playback')
-        else:
-            return Response('Playback is already playing')
-
-    def add_to_queue(self, tracks):
-        for track in tracks:
-            searched_track = self._search_track(track)
-            if searched_track is not None:
-                self.sp.add_to_queue(searched_track)
-            else:
-                print(f'could not play {searched_track}')
-
-        return Response(", ".join(tracks))
-
-    def switch_to_next_track(self):
-        self.sp.next_track()
-
-        return Response(self._get_current_playback()["item"]["name"])
-
-    def switch_to_previous_track(self):
-        self.sp.previous_track()
-        return Response('Switching to previous track...')
-
-    def get_user_current_playback(self):
-        current_playback = self._get_current_playback()
-
-        if current_playback is not None:
-            track_name = current_playback["item"]["name"]
-            artist_name = current_playback["item"]["artists"][0]["name"]
-            return Response(track_name + f' by {artist_name}')
-        else:
-            return Response('No track is currently playing')
-
-    def create_playlist_with_tracks(self, name: str, tracks: list):
-        playlist = self._create_playlist(name)
-        track_ids = [self._search_track(track) for track in tracks]
-
-        self.sp.playlist_add_items(playlist['id'], track_ids)
-
-        return Response(playlist['external_urls']['spotify'])
-
-    def get_user_top_tracks(self, tracks=50):
-        top_tracks = self._fetch_top_tracks(tracks)
-        top_tracks_names = [track['name'] for track in top_tracks]
-        top_tracks_artists = [track['artists'][0]['name'] for track in top_tracks]
-
-        for i in range(len(top_tracks_names)):
-            top_tracks_names[i] += f' by {top_tracks_artists[i]}'
-
-        return Response(listed_tracks=top_tracks_names)
-
-    def get_user_top_artists(self, tracks=50):
-        top_artists = self._fetch_top_artists(tracks)
-        top_artists_names = [artist['name'] for artist in top_artists]
-
-        return Response(listed_tracks=top_artists_names)
-
-
-class Response:
-    message_details: str
-    listed_tracks: str
-
-    def __init__(self, details='', listed_tracks=None):
-        self.message_details = details
-
-        if listed_tracks:
-            self.listed_tracks = "\n\n".join(listed_tracks)
-
-    def __str__(self):
-        if self.message_details:
-            return self.message_details
-        elif self.listed_tracks:
-            return self.listed_tracks
-        else:
-            return ''
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
+
+from library_index import LibraryIndex
+from playback_state import PlaybackState
+from playback_watcher import PlaybackWatcher, STOP_AFTER
+from playlist_pipeline import PlaylistPipeline, TOP_K
+from records import ArtistRecord, TrackRecord, render_for_model, render_for_ui
+from request_scheduler import RequestScheduler, ScheduledSpotify, BULK
+from search_cache import SearchCache, NOT_CACHED, normalize_query
+from top_items import TopItemsCache, DEFAULT_TIME_RANGE, PAGE_SIZE
+from tracing import traced
+
+# Spotify Web API accepts at most 100 items per playlist_add_items request
+PLAYLIST_ADD_LIMIT = 100
+# upper bound of concurrent search requests made while resolving tracks
+MAX_SEARCH_WORKERS = 8
+# statuses retried by the HTTP session itself, 429 isn't one of them as RequestScheduler handles it
+RETRIED_STATUSES = (500, 502, 503, 504)
+# seconds between refreshes of the library index, and how many saved tracks it takes at most
+LIBRARY_REFRESH_INTERVAL = 15 * 60
+MAX_LIBRARY_TRACKS = 2000
+# tracks a background job resolves between two progress reports (and checkpoints it can be resumed from)
+JOB_BATCH_SIZE = 20
+
+logger = logging.getLogger('spotbot.spotify_controller')
+
+
+def build_session(pool_size: int = 32):
+    # same retries spotipy sets up by default, except that 429 responses are left to RequestScheduler
+    retry = Retry(total=3,
+                  connect=None,
+                  read=False,
+                  allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                  status=3,
+                  backoff_factor=0.3,
+                  status_forcelist=RETRIED_STATUSES,
+                  respect_retry_after_header=False)
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@traced('spotify')
+class SpotifyController:
+    def __init__(self, credentials, scopes: str, search_cache: SearchCache = None,
+                 top_items_cache: TopItemsCache = None, client: spotipy.Spotify = None,
+                 scheduler: RequestScheduler = None, user: str = None):
+        # shared by every method that looks tracks up by name
+        self.search_cache = search_cache if search_cache is not None else SearchCache()
+        self.top_items_cache = top_items_cache if top_items_cache is not None else TopItemsCache()
+        self.playback_state = PlaybackState()
+        # set once watch_playback has started it
+        self.playback_watcher = None
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # set once start_library_index has built it
+        self.library_index = None
+        self._library_thread = None
+        self._library_touched = time.monotonic()
+        # stage by stage timing and hit rates of the last created playlist, see PlaylistPipeline.report
+        self.last_playlist_report = None
+        self._user_id = None
+
+        # an already set up client can be passed, e.g. one pointed at a fake server
+        if client is None:
+            try:
+                client = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scopes,
+                                                                   client_id=credentials['spotify']['client_id'],
+                                                                   client_secret=credentials['spotify'][
+                                                                       'client_secret'],
+                                                                   redirect_uri=credentials['spotify'][
+                                                                       'redirect_uri']),
+                                         requests_session=build_session())
+            except Exception as e:
+                print(f"Error initializing SpotifyController: \n{e}")
+                return
+
+        # every request goes through the scheduler, searches and pages made in bulk give way to playback commands
+        self.sp = ScheduledSpotify(client, self.scheduler, user or str(id(self)))
+        self._bulk_sp = self.sp.with_priority(BULK)
+
+
+
+    def _get_current_playback(self, refresh=False):
+        return self.playback_state.get(self.sp.current_playback, refresh=refresh)
+
+    @property
+    def _watched(self):
+        return self.playback_watcher is not None and self.playback_watcher.alive
+
+    def _read_playback(self):
+        # answers about the playback take the watcher's snapshot however old it is, only commands need a fresh one
+        if self._watched:
+            return self.playback_state.latest(self.sp.current_playback)
+        return self._get_current_playback()
+
+    def _change_playback(self, action, **optimistic_changes):
+        try:
+            action()
+        except spotipy.SpotifyException:
+            # the command may have been partially applied, so the snapshot is brought back in line with Spotify
+            self._get_current_playback(refresh=True)
+            raise
+
+        if optimistic_changes:
+            self.playback_state.update(**optimistic_changes)
+        else:
+            self.playback_state.invalidate()
+
+    def _get_user_id(self):
+        if self._user_id is None:
+            self._user_id = self.sp.me()['id']
+        return self._user_id
+
+    def _create_playlist(self, name: str):
+        return self.sp.user_playlist_create(self._get_user_id(), name)
+
+    def get_user_profile_name(self):
+        user = self.sp.me()
+        self._user_id = user['id']
+        return user['display_name'], user['external_urls']['spotify'], user['images'][0]['url']
+
+    def _fetch_top_items(self, kind: str, count=50, time_range=DEFAULT_TIME_RANGE, job=None):
+        user_id = self._get_user_id()
+
+        cached = self.top_items_cache.get(user_id, kind, time_range, count)
+        if cached is not None:
+            return cached
+
+        fetch_page = (self._bulk_sp.current_user_top_tracks if kind == 'tracks'
+                      else self._bulk_sp.current_user_top_artists)
+
+        def fetch(offset):
+            return fetch_page(limit=min(PAGE_SIZE, count - offset), offset=offset, time_range=time_range)
+
+        # the first page tells how many items there are, the rest of the pages are then fetched at once
+        first_page = fetch(0)
+        total = first_page['total']
+        offsets = range(PAGE_SIZE, min(count, total), PAGE_SIZE)
+
+        items = list(first_page['items'])
+        if offsets:
+            with ThreadPoolExecutor(max_workers=len(offsets)) as executor:
+                for page in executor.map(fetch, offsets):
+                    items += page['items']
+                    if job is not None:
+                        job.check_cancelled()
+                        wanted = min(count, total)
+                        job.progress(len(items), wanted, f'fetched {len(items)}/{wanted} top {kind}')
+
+        self.top_items_cache.set(user_id, kind, time_range, items, total)
+        return items
+
+    def _search_track(self, query: str, bulk=False):
+        # tracks from the user's own library are found without asking Spotify, and in the version they know
+        if self.library_index is not None:
+            uri = self.library_index.lookup(query)
+            if uri is not None:
+                return uri
+
+        cached = self.search_cache.get(query)
+        if cached is not NOT_CACHED:
+            return cached
+
+        items = (self._bulk_sp if bulk else self.sp).search(query, limit=1)['tracks']['items']
+        uri = items[0]['uri'] if items else None
+
+        self.search_cache.set(query, uri)
+        return uri
+
+    def _search_tracks(self, query: str, limit: int = TOP_K):
+        return self._bulk_sp.search(query, limit=limit)['tracks']['items']
+
+    def _add_to_playlist(self, playlist_id: str, uris: list):
+        for i in range(0, len(uris), PLAYLIST_ADD_LIMIT):
+            self._bulk_sp.playlist_add_items(playlist_id, uris[i:i + PLAYLIST_ADD_LIMIT])
+
+    def _resolve_tracks(self, tracks: list):
+        # searches run concurrently, but results keep the order of given tracks
+        if not tracks:
+            return []
+
+        # the same track asked for twice is searched only once
+        queries = list({normalize_query(track): track for track in tracks}.values())
+
+        with ThreadPoolExecutor(max_workers=min(MAX_SEARCH_WORKERS, len(queries))) as executor:
+            uris = dict(zip(map(normalize_query, queries), executor.map(partial(self._search_track, bulk=True), queries)))
+
+        return [(track, uris[normalize_query(track)]) for track in tracks]
+
+    def _fetch_saved_tracks(self, since: str = ''):
+        # saved tracks (with their 'added_at') added after `since`, newest first
+        def fetch(offset):
+            return self._bulk_sp.current_user_saved_tracks(limit=PAGE_SIZE, offset=offset)
+
+        if since:
+            # pages are fetched one by one until they reach tracks that were saved before
+            items = []
+            for offset in range(0, MAX_LIBRARY_TRACKS, PAGE_SIZE):
+                page = fetch(offset)['items']
+                new_items = [item for item in page if item['added_at'] > since]
+                items += new_items
+                if len(new_items) < len(page) or len(page) < PAGE_SIZE:
+                    break
+            return items
+
+        first_page = fetch(0)
+        offsets = range(PAGE_SIZE, min(MAX_LIBRARY_TRACKS, first_page['total']), PAGE_SIZE)
+
+        items = list(first_page['items'])
+        if offsets:
+            with ThreadPoolExecutor(max_workers=min(MAX_SEARCH_WORKERS, len(offsets))) as executor:
+                for page in executor.map(fetch, offsets):
+                    items += page['items']
+        return items
+
+    def _refresh_library(self, index: LibraryIndex):
+        saved = self._fetch_saved_tracks(index.saved_until)
+        index.add([item['track'] for item in saved], 'saved')
+        if saved:
+            index.saved_until = max(item['added_at'] for item in saved)
+
+        for time_range in ('short_term', DEFAULT_TIME_RANGE):
+            index.add(self._fetch_top_items('tracks', count=PAGE_SIZE, time_range=time_range), 'top')
+
+        recently_played = self._bulk_sp.current_user_recently_played(limit=PAGE_SIZE)['items']
+        index.add([item['track'] for item in recently_played], 'recent')
+
+        index.save()
+
+    def start_library_index(self, directory: str = None, interval: float = LIBRARY_REFRESH_INTERVAL):
+        # builds the library index in the background and keeps it up to date, with a directory
+        # it's also saved there, so after a restart lookups use it before the first refresh is done;
+        # like the playback watcher it stops refreshing once nobody called this for STOP_AFTER, and a later
+        # call starts it again
+        self._library_touched = time.monotonic()
+        if self._library_thread is not None and self._library_thread.is_alive():
+            return
+
+        def run():
+            index = self.library_index
+            if index is None:
+                try:
+                    path = None
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                        path = os.path.join(directory, f'{self._get_user_id()}.json')
+                    index = LibraryIndex(path)
+                except Exception as e:
+                    logger.warning(f'Could not load the library index: {e}')
+                    index = LibraryIndex()
+                if len(index):
+                    self.library_index = index
+
+            while True:
+                try:
+                    self._refresh_library(index)
+                    self.library_index = index
+                except Exception as e:
+                    logger.warning(f'Could not refresh the library index: {e}')
+                time.sleep(interval)
+                if time.monotonic() - self._library_touched >= STOP_AFTER:
+                    break
+
+        self._library_thread = threading.Thread(target=run, daemon=True, name='library-index')
+        self._library_thread.start()
+
+    def watch_playback(self):
+        # starts the playback watcher, or keeps it going, as a watcher nobody asked about for a while stops itself
+        if self.playback_watcher is None or not self.playback_watcher.alive:
+            self.playback_watcher = PlaybackWatcher(self._bulk_sp.current_playback,
+                                                    lambda: self._bulk_sp.devices()['devices'],
+                                                    self.playback_state).start()
+        self.playback_watcher.touch()
+
+    def now_playing(self):
+        # the last known playback, without making a request, and how many seconds old it is
+        return self.playback_state.cached()[1], self.playback_state.age()
+
+    def _fetch_devices(self):
+        return self.sp.devices()['devices']
+
+    def knows_devices(self):
+        # whether is_device_active can answer from the watcher's snapshot, without a request
+        return self._watched and self.playback_state.has_devices()
+
+    def is_device_active(self, refresh=False):
+        if self._watched and not refresh:
+            devices = self.playback_state.latest_devices(self._fetch_devices)
+        else:
+            devices = self.playback_state.get_devices(self._fetch_devices, refresh=refresh)
+        for device in devices:
+            if device['is_active']:
+                return True
+        return False
+
+    def play_track(self, track_uri=None, track_name=None):
+        if track_uri:
+            self.sp.add_to_queue(track_uri)
+            self._change_playback(self.sp.next_track)
+            # self.sp.start_playback(uris=[track_uri])
+        if track_name:
+            track = self._search_track(track_name)
+            if track is None:
+                return Response(f'Could not find {track_name}', success=False)
+
+            # sp.start_playback plays the given track, but unfortunately erases a queue, so it's better to use
+            # add_to_queue and next_track
+
+            self.sp.add_to_queue(track)
+            self._change_playback(self.sp.next_track)
+
+            # self.sp.start_playback(uris=[track])
+        else:
+            return None
+        return Response(track_name)
+
+    def pause_playback(self):
+        current_playback = self._get_current_playback()
+        if current_playback is not None and current_playback['is_playing']:
+            self._change_playback(self.sp.pause_playback, is_playing=False)
+            return Response('Stopped playback')
+        else:
+            return Response('Playback is already paused')
+
+    def resume_playback(self):
+        current_playback = self._get_current_playback()
+        if current_playback is None or not current_playback['is_playing']:
+            self._change_playback(self.sp.start_playback, is_playing=True)
+            return Response('Resumed playback')
+        else:
+            return Response('Playback is already playing')
+
+    def add_to_queue(self, tracks, job=None):
+        checkpoint = job.checkpoint if job is not None else {}
+        added, missing = list(checkpoint.get('added', [])), list(checkpoint.get('missing', []))
+
+        for start, batch in _track_batches(tracks, job):
+            # queue has to be filled one by one in the requested order
+            for track, uri in self._resolve_tracks(batch):
+                if uri is not None:
+                    self.sp.add_to_queue(uri)
+                    added.append(track)
+                else:
+                    missing.append(track)
+
+            if job is not None:
+                done = start + len(batch)
+                job.save(added=added, missing=missing, done=done)
+                job.progress(done, len(tracks), f'queued {done}/{len(tracks)} tracks')
+
+        return Response(_describe_resolution(added, missing), success=bool(added))
+
+    def switch_to_next_track(self):
+        # Spotify needs a moment to switch, so reading the playback right away would mostly return the old track
+        self._change_playback(self.sp.next_track)
+
+        return Response('to the next track')
+
+    def switch_to_previous_track(self):
+        self._change_playback(self.sp.previous_track)
+        return Response('Switching to previous track...')
+
+    def get_user_current_playback(self):
+        current_playback = self._read_playback()
+
+        if current_playback is not None and current_playback['item'] is not None:
+            track_name = current_playback["item"]["name"]
+            artist_name = current_playback["item"]["artists"][0]["name"]
+            return Response(track_name + f' by {artist_name}')
+        else:
+            return Response('No track is currently playing')
+
+    def create_playlist_with_tracks(self, name: str, tracks: list, size: int = None, job=None):
+        # tracks are candidates, best first, of which `size` distinct ones make it into the playlist
+        checkpoint = job.checkpoint if job is not None else {}
+        playlist = checkpoint.get('playlist') or self._create_playlist(name)
+        if job is not None:
+            job.save(playlist=playlist)
+
+        size = size or len(tracks)
+        pipeline = PlaylistPipeline(self._search_tracks, partial(self._add_to_playlist, playlist['id']), size,
+                                    library_index=self.library_index, search_cache=self.search_cache,
+                                    batch_size=JOB_BATCH_SIZE if job is not None else None)
+        uris, missing = pipeline.run(tracks, job)
+        self.last_playlist_report = pipeline.report()
+
+        return Response(_describe_playlist(playlist, uris, size, missing))
+
+    def get_user_top_tracks(self, tracks=50, time_range=DEFAULT_TIME_RANGE, job=None):
+        top_tracks = self._fetch_top_items('tracks', tracks, time_range, job)
+
+        return Response(records=[TrackRecord.from_track(track) for track in top_tracks])
+
+    def get_user_top_artists(self, tracks=50, time_range=DEFAULT_TIME_RANGE, job=None):
+        top_artists = self._fetch_top_items('artists', tracks, time_range, job)
+
+        return Response(records=[ArtistRecord.from_artist(artist) for artist in top_artists])
+
+
+def _track_batches(tracks: list, job):
+    # without a job all tracks are resolved at once, a job goes batch by batch from where it left off
+    if job is None:
+        yield 0, tracks
+        return
+
+    for start in range(job.checkpoint.get('done', 0), len(tracks), JOB_BATCH_SIZE):
+        job.check_cancelled()
+        yield start, tracks[start:start + JOB_BATCH_SIZE]
+
+
+def _describe_resolution(found: list, missing: list):
+    if not found:
+        return f'Could not find {", ".join(missing)}'
+
+    details = ", ".join(found)
+    if missing:
+        details += f' (could not find: {", ".join(missing)})'
+    return details
+
+
+def _describe_playlist(playlist: dict, uris: list, size: int, missing: list):
+    details = playlist['external_urls']['spotify']
+    if len(uris) < size:
+        details += f' ({len(uris)} of {_tracks(size)}, could not find: {", ".join(missing)})'
+    elif missing:
+        details += f' (in place of {_tracks(len(missing))} that could not be found)'
+    return details
+
+
+def _tracks(count: int):
+    return f'{count} track' if count == 1 else f'{count} tracks'
+
+
+class Response:
+    message_details: str
+    records: list
+    success: bool
+
+    def __init__(self, details='', records=None, success=True):
+        self.message_details = details
+        # TrackRecords or ArtistRecords, e.g. of top tracks
+        self.records = records or []
+        # False when nothing was done, e.g. a track couldn't be found
+        self.success = success
+
+    def table(self):
+        # every record, for the chat to show as a table
+        return render_for_ui(self.records)
+
+    def __str__(self):
+        # what the model gets to see, long lists are cut short
+        if self.message_details:
+            return self.message_details
+        return render_for_model(self.records)
@@ -0,0 +1,126 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from spotipy.cache_handler import CacheHandler
+
+logger = logging.getLogger('spotbot.token_store')
+
+
+class MemoryTokenStore:
+    # Spotify tokens of every session of this process, lost on restart
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_key: str):
+        with self._lock:
+            return self._tokens.get(session_key)
+
+    def set(self, session_key: str, token_info: dict):
+        with self._lock:
+            self._tokens[session_key] = token_info
+
+    def delete(self, session_key: str):
+        with self._lock:
+            self._tokens.pop(session_key, None)
+
+    def items(self):
+        with self._lock:
+            return list(self._tokens.items())
+
+
+class SQLiteTokenStore:
+    # Spotify tokens of every session, kept across restarts
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS tokens (session_key TEXT PRIMARY KEY, token_info TEXT)')
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, session_key: str):
+        with self._lock:
+            row = self._db.execute('SELECT token_info FROM tokens WHERE session_key = ?', (session_key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_key: str, token_info: dict):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?)', (session_key, json.dumps(token_info)))
+            self._db.commit()
+
+    def delete(self, session_key: str):
+        with self._lock:
+            self._db.execute('DELETE FROM tokens WHERE session_key = ?', (session_key,))
+            self._db.commit()
+
+    def items(self):
+        with self._lock:
+            rows = self._db.execute('SELECT session_key, token_info FROM tokens').fetchall()
+        return [(session_key, json.loads(token_info)) for session_key, token_info in rows]
+
+
+class SessionCacheHandler(CacheHandler):
+    # lets spotipy's OAuth manager read and save the token of one session in a token store
+    def __init__(self, store, session_key: str):
+        self.store = store
+        self.session_key = session_key
+
+    def get_cached_token(self):
+        return self.store.get(self.session_key)
+
+    def save_token_to_cache(self, token_info):
+        self.store.set(self.session_key, token_info)
+
+
+class TokenRefresher:
+    # Refreshes tokens in the store a while before they expire, so no request has to wait for a refresh.
+    # make_auth_manager(session_key) returns an OAuth manager that saves the refreshed token for that session.
+    # Only sessions touched in the last idle_after seconds are refreshed, one that comes back later has its
+    # token refreshed by its first request.
+    def __init__(self, store, make_auth_manager, interval: float = 60, margin: float = 10 * 60,
+                 idle_after: float = 30 * 60):
+        self.store = store
+        self.make_auth_manager = make_auth_manager
+        self.interval = interval
+        self.margin = margin
+        self.idle_after = idle_after
+
+        # session key -> time.monotonic() it was last touched
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='token-refresher')
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def touch(self, session_key: str):
+        with self._lock:
+            self._touched[session_key] = time.monotonic()
+
+    def refresh_due(self):
+        with self._lock:
+            now = time.monotonic()
+            for session_key in [key for key, touched in self._touched.items() if now - touched > self.idle_after]:
+                del self._touched[session_key]
+            active = set(self._touched)
+
+        for session_key, token_info in self.store.items():
+            if session_key not in active:
+                continue
+            if not token_info.get('refresh_token') or token_info.get('expires_at', 0) - time.time() > self.margin:
+                continue
+            try:
+                self.make_auth_manager(session_key).refresh_access_token(token_info['refresh_token'])
+            except Exception as e:
+                logger.warning(f'Could not refresh token of session {session_key}: {e}')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh_due()
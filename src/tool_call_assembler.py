@@ -0,0 +1,60 @@
+import json
+
+
+class ToolCallAssembler:
+    # Puts tool calls together from streamed fragments and hands each one to on_complete(name, arguments) as
+    # soon as its arguments are complete: when they parse as a JSON object, or, for a call that got no arguments,
+    # when a call with a later index starts. Fragments of several calls can come interleaved, even in one delta.
+    # Calls are handed over in index order, so mutations keep the order the model asked for them in.
+    def __init__(self, on_complete):
+        self.on_complete = on_complete
+
+        # index -> {'name': ..., 'args': ..., 'complete': ..., 'dispatched': ...}
+        self._calls = {}
+
+    def feed(self, tool_call_deltas):
+        # a single delta can carry fragments of several calls
+        for delta in tool_call_deltas:
+            call = self._calls.get(delta.index)
+            if call is None:
+                call = self._calls[delta.index] = {'name': '', 'args': '', 'complete': False,
+                                                     'dispatched': False}
+                # a call without arguments, like pause_playback, is done once the model moves on to the next one
+                for index, earlier in self._calls.items():
+                    if index < delta.index and earlier['name'] and not earlier['args'].strip():
+                        earlier['complete'] = True
+
+            if delta.function is not None:
+                call['name'] += delta.function.name or ''
+                call['args'] += delta.function.arguments or ''
+
+            if not call['complete'] and call['name'] and _parses(call['args']):
+                call['complete'] = True
+
+        self._dispatch()
+
+    def finish(self):
+        # the stream ended, whatever is left is complete
+        for call in self._calls.values():
+            call['complete'] = True
+        self._dispatch()
+
+    def _dispatch(self):
+        for index in sorted(self._calls):
+            call = self._calls[index]
+            if call['dispatched']:
+                continue
+            if not call['complete']:
+                break
+            call['dispatched'] = True
+            self.on_complete(call['name'], json.loads(call['args'] or '{}'))
+
+
+def _parses(args: str):
+    # cheap check first, most fragments don't end an object
+    if not args.rstrip().endswith('}'):
+        return False
+    try:
+        return isinstance(json.loads(args), dict)
+    except json.JSONDecodeError:
+        return False
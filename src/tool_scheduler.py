@@ -0,0 +1,171 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# seconds a single tool call may run before the turn carries on without it
+TOOL_TIMEOUT = 20
+# calls whose 'cost' in the function map is above this run as background jobs, with no timeout
+JOB_COST_THRESHOLD = 50
+# seconds between checks of a job's progress
+JOB_POLL_INTERVAL = 0.25
+
+# shared by all sessions, so a timed out call doesn't hold up the one who gave up on it; only calls that are
+# actually running take a worker, waiting for earlier calls and jobs doesn't
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='tool-call')
+
+
+class ToolResult:
+    def __init__(self, name: str, arguments: dict, result=None, error: str = None):
+        self.name = name
+        self.arguments = arguments
+        self.result = result
+        self.error = error
+
+
+class _ScheduledCall:
+    def __init__(self, name: str, arguments: dict):
+        self.name = name
+        self.arguments = arguments
+        self.started = threading.Event()
+        self.started_at = None
+        # resolved with the call's ToolResult once it's done, timed out, skipped or its job has finished
+        self.future = Future()
+        # name of the call that didn't finish in time, if this one timed out or was skipped because of it
+        self.unfinished = None
+        self._resolved = False
+        self._lock = threading.Lock()
+        # the background job running the call, if it's an expensive one
+        self.job = None
+
+
+class ToolScheduler:
+    # Runs tool calls of a single turn. Calls marked as 'read_only' in the function map run in parallel,
+    # the rest (playback and queue changes) run one by one in the order they were requested. A read waits for
+    # mutations requested before it, and a mutation waits for everything requested before it.
+    # With a job queue, expensive calls run as jobs of `owner`, so they outlive the turn that started them.
+    def __init__(self, function_map: dict, timeout: float = TOOL_TIMEOUT, trace=None, job_queue=None,
+                 owner: str = None):
+        self.function_map = function_map
+        self.timeout = timeout
+        # TurnTrace the duration of every call is added to
+        self.trace = trace
+        self.job_queue = job_queue
+        self.owner = owner
+
+        self._last_mutation = None
+        self._reads_since_mutation = []
+
+    def submit(self, name: str, arguments: dict):
+        call = _ScheduledCall(name, arguments)
+
+        if self.function_map[name].get('read_only'):
+            dependencies = [self._last_mutation] if self._last_mutation else []
+            self._reads_since_mutation.append(call)
+        else:
+            dependencies = ([self._last_mutation] if self._last_mutation else []) + self._reads_since_mutation
+            self._last_mutation = call
+            self._reads_since_mutation = []
+
+        self._after(dependencies, lambda: self._start(call, dependencies))
+        return call
+
+    def result(self, call: _ScheduledCall):
+        # the timeout counts from the moment the call starts, not while it waits for earlier calls, a job has none
+        return call.future.result()
+
+    def job_updates(self, call: _ScheduledCall, interval: float = JOB_POLL_INTERVAL):
+        # if the call runs as a job, yields its status every time it changes until the job finishes
+        call.started.wait()
+        if call.job is None:
+            return
+
+        status = None
+        while not call.job.wait(interval):
+            if call.job.status != status:
+                status = call.job.status
+                yield status
+
+    def run(self, calls: list):
+        # calls are (name, arguments) pairs, results come back in the same order
+        scheduled = [self.submit(name, arguments) for name, arguments in calls]
+        return [self.result(call) for call in scheduled]
+
+    def _after(self, dependencies: list, start):
+        # start() runs as soon as every dependency is resolved, in the thread that resolved the last one
+        remaining = [len(dependencies)]
+        lock = threading.Lock()
+
+        def resolved(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                start()
+
+        if not dependencies:
+            start()
+        for dependency in dependencies:
+            dependency.future.add_done_callback(resolved)
+
+    def _start(self, call: _ScheduledCall, dependencies: list):
+        # a call after one that didn't finish in time is skipped, and so is everything after that, as the unfinished
+        # call may still be running; a job has no timeout, calls after it wait until it's done
+        unfinished = next((dependency.unfinished for dependency in dependencies if dependency.unfinished), None)
+
+        entry = self.function_map[call.name]
+        cost = entry.get('cost')
+        if unfinished is None and self.job_queue is not None and cost and cost(call.arguments) > JOB_COST_THRESHOLD:
+            call.job = self.job_queue.submit(call.name, entry['func'], call.arguments, self.owner)
+
+        call.started_at = time.monotonic()
+        call.started.set()
+
+        if unfinished is not None:
+            self._finish(call, ToolResult(call.name, call.arguments,
+                                          error=f'skipped, as earlier {unfinished} call did not finish'),
+                         unfinished=unfinished)
+        elif call.job is not None:
+            call.job.add_done_callback(lambda job: self._finish_job(call))
+        else:
+            timer = threading.Timer(self.timeout, self._time_out, args=(call,))
+            timer.daemon = True
+            timer.start()
+            _executor.submit(self._execute, call, timer)
+
+    def _execute(self, call: _ScheduledCall, timer: threading.Timer):
+        try:
+            result = self.function_map[call.name]['func'](**call.arguments)
+            result = ToolResult(call.name, call.arguments, result=result)
+        except Exception as e:
+            result = ToolResult(call.name, call.arguments, error=str(e))
+        finally:
+            timer.cancel()
+            if self.trace is not None:
+                self.trace.add(f'tool.{call.name}', time.monotonic() - call.started_at)
+        self._finish(call, result)
+
+    def _time_out(self, call: _ScheduledCall):
+        # the call keeps its worker until it returns, but the turn and the calls after it don't wait for it
+        self._finish(call, ToolResult(call.name, call.arguments, error=f'timed out after {self.timeout:g}s'),
+                     unfinished=call.name)
+
+    def _finish_job(self, call: _ScheduledCall):
+        if self.trace is not None:
+            self.trace.add(f'tool.{call.name}', time.monotonic() - call.started_at)
+        if call.job.error:
+            self._finish(call, ToolResult(call.name, call.arguments, error=call.job.error))
+        elif call.job.result is None:
+            self._finish(call, ToolResult(call.name, call.arguments,
+                                          error='cancelled, it can be resumed from the sidebar'))
+        else:
+            self._finish(call, ToolResult(call.name, call.arguments, result=call.job.result))
+
+    @staticmethod
+    def _finish(call: _ScheduledCall, result: ToolResult, unfinished: str = None):
+        # whichever comes first of the result and the timeout resolves the call
+        with call._lock:
+            if call._resolved:
+                return
+            call._resolved = True
+            call.unfinished = unfinished
+        call.future.set_result(result)
@@ -0,0 +1,247 @@
+# tool schema sent to the model and mapping of tool names to controller methods
+
+from playlist_pipeline import OVERSAMPLING
+from top_items import TIME_RANGES
+
+# how the reply to a tool call is made:
+# template - the tool's 'message' is rendered right away, without asking the model,
+# llm - the model phrases the reply based on the tool's result,
+# hybrid - template, unless the tool is marked as 'rich' (its result is worth a proper answer)
+TEMPLATE = 'template'
+LLM = 'llm'
+HYBRID = 'hybrid'
+RESPONSE_MODES = (HYBRID, TEMPLATE, LLM)
+
+TIME_RANGE_PARAMETER = {
+    "type": "string",
+    "enum": list(TIME_RANGES),
+    "description": "Period to get the favorites from: short_term is about the last 4 weeks, medium_term the last "
+                   "6 months and long_term all time. Use long_term if the user doesn't say"
+}
+
+# results listing tracks or artists are shown as a table under the tool's 'message', so it only introduces them
+# tools marked as 'read_only' don't change anything on user's account, so they can be called in parallel,
+# 'cost' estimates how many tracks a call works through, expensive calls run as background jobs
+
+
+def build_function_map(sp):
+    return {
+        'play_track': {
+            'func': sp.play_track,
+            'message': lambda message: f'Playing {message}'
+        },
+        'pause_playback': {
+            'func': sp.pause_playback,
+            'message': lambda message: str(message)
+        },
+        'resume_playback': {
+            'func': sp.resume_playback,
+            'message': lambda message: str(message)
+        },
+        'add_to_queue': {
+            'func': sp.add_to_queue,
+            'message': lambda message: f'Added {message} to a queue',
+            'cost': lambda arguments: len(arguments.get('tracks', []))
+        },
+        'switch_to_next_track': {
+            'func': sp.switch_to_next_track,
+            'message': lambda message: f'Skipping {message}'
+        },
+        'switch_to_previous_track': {
+            'func': sp.switch_to_previous_track,
+            'message': lambda message: f'Switching to previous track...'
+        },
+        'get_user_current_playback': {
+            'func': sp.get_user_current_playback,
+            'message': lambda message: f'Currently playing: {message}',
+            'read_only': True
+        },
+        'create_playlist_with_tracks': {
+            'func': sp.create_playlist_with_tracks,
+            'message': lambda message: f'Here\'s your playlist: {message}',
+            'rich': True,
+            'cost': lambda arguments: arguments.get('size') or len(arguments.get('tracks', []))
+        },
+        'get_user_top_tracks': {
+            'func': sp.get_user_top_tracks,
+            'message': lambda message: 'Here are your top tracks:',
+            'rich': True,
+            'read_only': True,
+            'cost': lambda arguments: arguments.get('tracks', 50)
+        },
+        'get_user_top_artists': {
+            'func': sp.get_user_top_artists,
+            'message': lambda message: 'Here are your top artists:',
+            'rich': True,
+            'read_only': True,
+            'cost': lambda arguments: arguments.get('tracks', 50)
+        },
+    }
+
+
+def build_tools(username: str):
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": "play_track",
+                "description": "Play a song. Call this whenever you are asked to play something, "
+                               "for example when user says 'play a Xtal by Aphex Twin', you should call this "
+                               "function with parameter 'Xtal Aphex Twin'.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "track_name": {
+                            "type": "string",
+                            "description": "Title name and artist name of a track to play"
+                        },
+                    },
+                    "required": ["track_name"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "pause_playback",
+                "description": "Pause playback of a track. Call this whenever you are asked to stop or pause "
+                               "playing something, for example when user says 'pause'"
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "resume_playback",
+                "description": "Resume playback of a track. Call this whenever you are asked to resume or "
+                               "start playing something (but if user asks you to play a certain song, "
+                               "you should not call this function), for example when user says 'play' without "
+                               "track's title",
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "switch_to_next_track",
+                "description": "Switch current playback to a next track. For example, when users says 'play next "
+                               "track', you should call this function.",
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "switch_to_previous_track",
+                "description": "Switch current playback to a previous track. For example, when users says 'play"
+                               " previous track', you should call this function",
+
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "add_to_queue",
+                "description": "Add tracks to a playing queue. For example, when user says 'add to queue track1 and "
+                               "track2', you should call this function with parameter ['track1', 'track2']",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "tracks": {
+                            "type": "array",
+                            "items": {
+                                "type": "string"
+                            },
+                            "description": "Titles of tracks alongside with it's authors, each and every one put "
+                                           "in a list"
+                        },
+                    },
+                    "required": ["tracks"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "get_user_current_playback",
+                "description": "Get current playback. For example, when users says 'what is playing', "
+                               "you should call this function",
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "create_playlist_with_tracks",
+                "description": "Create a playlist with tracks. Call this function when you want to create a "
+                               "playlist that contains the tracks and it's authors based on description. "
+                               "Suggest more tracks than the playlist should have, the ones that can't be found "
+                               "are replaced by the extra ones.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "tracks": {
+                            "type": "array",
+                            "items": {
+                                "type": "string"
+                            },
+                            "description": "Tracks in form 'title by artist', best fitting first, about "
+                                           f"{OVERSAMPLING:g} times as many as the size of the playlist, "
+                                           f"e.g. {int(OVERSAMPLING * 20)} for a playlist of 20."
+                        },
+                        "size": {
+                            "type": "integer",
+                            "description": "Number of tracks the playlist should have. If the user doesn't say, "
+                                           "pick one that fits the request"
+                        },
+                        "name": {
+                            "type": "string",
+                            "description": "Name of the playlist. If not provided, come up with a creative name "
+                                           "yourself"
+                        }
+                    },
+                    "required": ["tracks", "name"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "get_user_top_tracks",
+                "description": f"Get {username}'s favorite tracks. Call this function when you want to get "
+                               "top tracks, e.g. user's favorite songs. Try to get the number of tracks and pass "
+                               "it in a parameter, as well as the period they're asking about",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "tracks": {
+                            "type": "integer",
+                            "description": "Number of top tracks to get"
+                        },
+                        "time_range": TIME_RANGE_PARAMETER
+                    },
+                    "required": ["tracks"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "get_user_top_artists",
+                "description": f"Get {username}'s favorite artists, performers or authors. Try to get the "
+                               'number of them and pass it in a parameter, as well as the period they\'re asking about',
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "tracks": {
+                            "type": "integer",
+                            "description": "Number of top artists to get"
+                        },
+                        "time_range": TIME_RANGE_PARAMETER
+                    },
+                    "required": ["tracks"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+    ]
@@ -0,0 +1,42 @@
+import threading
+import time
+
+# periods Spotify computes top items for: roughly last 4 weeks, last 6 months and all time
+TIME_RANGES = ('short_term', 'medium_term', 'long_term')
+DEFAULT_TIME_RANGE = 'long_term'
+# the most items current_user_top_tracks and current_user_top_artists return at once
+PAGE_SIZE = 50
+
+
+class TopItemsCache:
+    # keeps fetched top tracks and artists per user and time range; top items change slowly,
+    # so they are fetched again only after refresh_interval
+    def __init__(self, refresh_interval: float = 30 * 60):
+        self.refresh_interval = refresh_interval
+
+        # (user_id, kind, time_range) -> (items, total, fetched_at)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, kind: str, time_range: str, count: int):
+        with self._lock:
+            entry = self._entries.get((user_id, kind, time_range))
+
+        if entry is None:
+            return None
+
+        items, total, fetched_at = entry
+        if time.monotonic() - fetched_at > self.refresh_interval:
+            return None
+        # fewer items than asked for are fine only if that's all the user has
+        if len(items) < count and len(items) < total:
+            return None
+        return items[:count]
+
+    def set(self, user_id: str, kind: str, time_range: str, items: list, total: int):
+        with self._lock:
+            self._entries[(user_id, kind, time_range)] = (items, total, time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,216 @@
+import functools
+import inspect
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('spotbot.tracing')
+
+# how many most recent durations of each phase are kept to compute percentiles from
+WINDOW = 500
+
+
+class _JSONLineFormatter(logging.Formatter):
+    # events are logged as JSON already, anything else (e.g. warnings) is wrapped, so the log stays one JSON
+    # object per line
+    def format(self, record: logging.LogRecord):
+        message = record.getMessage()
+        if message.startswith('{'):
+            return message
+        return json.dumps({'event': 'log', 'level': record.levelname, 'logger': record.name, 'message': message})
+
+
+class TurnTrace:
+    # Durations of the phases of a single chat turn, in the order they were recorded. Phases can be
+    # added from other threads, e.g. by tool calls running in parallel.
+    # The startup of a session is traced the same way, as a trace of kind 'startup'.
+    def __init__(self, tracer, kind: str = 'turn', started: float = None):
+        self.tracer = tracer
+        self.kind = kind
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.phases.append((name, seconds))
+        self.tracer.record(f'{self.kind}.{name}', seconds)
+
+    def mark(self, name: str):
+        # time from the start of the turn, e.g. to the first token
+        self.add(name, time.perf_counter() - self.started)
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def finish(self):
+        self.mark('total')
+        self.tracer.finish_turn(self)
+
+    def breakdown(self):
+        with self._lock:
+            return [{'phase': name, 'ms': round(seconds * 1000, 1)} for name, seconds in self.phases]
+
+
+class Tracer:
+    def __init__(self):
+        self.last_turn = None
+
+        self._durations = {}
+        self._counts = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+
+        self._log_handler = None
+        self._prometheus_file = None
+        # name -> function returning a dict of current values, e.g. queue depth of the request scheduler
+        self._gauges = {}
+
+    def configure(self, log_file: str = None, prometheus_file: str = None, prometheus_port: int = None,
+                  log_level: str = 'INFO'):
+        # everything the spotbot loggers log from log_level up (finished turns, routing decisions, playlists,
+        # warnings) is appended to log_file as JSON lines, prometheus_file is rewritten with current metrics
+        # after every turn and prometheus_port serves them on /metrics
+        spotbot_logger = logging.getLogger('spotbot')
+        if self._log_handler is not None:
+            spotbot_logger.removeHandler(self._log_handler)
+            self._log_handler.close()
+            self._log_handler = None
+        if log_file:
+            self._log_handler = logging.FileHandler(log_file)
+            self._log_handler.setFormatter(_JSONLineFormatter())
+            spotbot_logger.addHandler(self._log_handler)
+            spotbot_logger.setLevel(log_level)
+        self._prometheus_file = prometheus_file
+        if prometheus_port:
+            self._serve(prometheus_port)
+
+    def register_gauges(self, name: str, values):
+        self._gauges[name] = values
+
+    def start_turn(self, kind: str = 'turn', started: float = None):
+        return TurnTrace(self, kind, started)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self._durations.setdefault(name, deque(maxlen=WINDOW)).append(seconds)
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._sums[name] = self._sums.get(name, 0.0) + seconds
+
+    def finish_turn(self, trace: TurnTrace):
+        if trace.kind == 'turn':
+            self.last_turn = trace
+
+        logger.info(json.dumps({'event': trace.kind, 'phases': trace.breakdown()}))
+        if self._prometheus_file:
+            with open(self._prometheus_file, 'w') as file:
+                file.write(self.prometheus_text())
+
+    def percentiles(self):
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+            counts = dict(self._counts)
+
+        return [{
+            'phase': name,
+            'count': counts[name],
+            'p50 ms': round(_quantile(durations, 0.5) * 1000, 1),
+            'p95 ms': round(_quantile(durations, 0.95) * 1000, 1),
+        } for name, durations in sorted(snapshot.items())]
+
+    def prometheus_text(self):
+        lines = ['# HELP spotbot_duration_seconds Duration of chat turn phases and Spotify calls.',
+                 '# TYPE spotbot_duration_seconds summary']
+
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+            counts, sums = dict(self._counts), dict(self._sums)
+
+        for name, durations in sorted(snapshot.items()):
+            for quantile in (0.5, 0.95):
+                lines.append(f'spotbot_duration_seconds{{name="{name}",quantile="{quantile}"}} '
+                             f'{_quantile(durations, quantile):.6f}')
+            lines.append(f'spotbot_duration_seconds_sum{{name="{name}"}} {sums[name]:.6f}')
+            lines.append(f'spotbot_duration_seconds_count{{name="{name}"}} {counts[name]}')
+
+        for name, values in sorted(self._gauges.items()):
+            for key, value in values().items():
+                lines.append(f'# TYPE spotbot_{name}_{key} gauge')
+                lines.append(f'spotbot_{name}_{key} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _serve(self, port: int):
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tracer.prometheus_text().encode()
+                self.send_response(200 if self.path == '/metrics' else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+
+
+def _quantile(durations: list, quantile: float):
+    if len(durations) == 1:
+        return durations[0]
+    return statistics.quantiles(durations, n=100, method='inclusive')[round(quantile * 100) - 1]
+
+
+# one per process, shared by every session
+TRACER = Tracer()
+
+
+def traced(prefix: str):
+    # class decorator timing every public method, e.g. SpotifyController.play_track as 'spotify.play_track'
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith('_') or not inspect.isfunction(method):
+                continue
+            setattr(cls, name, _timed(method, f'{prefix}.{name}'))
+        return cls
+    return decorate
+
+
+def _timed(method, name: str):
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                _record_call(name, time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _record_call(name, time.perf_counter() - start)
+    return wrapper
+
+
+def _record_call(name: str, seconds: float):
+    TRACER.record(name, seconds)
+    logger.debug(json.dumps({'event': 'call', 'name': name, 'ms': round(seconds * 1000, 1)}))
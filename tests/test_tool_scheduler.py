@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from tool_scheduler import ToolScheduler  # noqa: E402
+
+
+class ToolSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        # (name, start, end) of every call that ran
+        self.calls = []
+
+    def _tool(self, name: str, seconds: float = 0.0, read_only: bool = False):
+        def func():
+            started = time.monotonic()
+            time.sleep(seconds)
+            self.calls.append((name, started, time.monotonic()))
+            return name
+        return {'func': func, 'read_only': read_only}
+
+    def test_calls_after_a_timed_out_mutation_are_skipped(self):
+        function_map = {'slow': self._tool('slow', 1.0), 'm1': self._tool('m1'), 'm2': self._tool('m2'),
+                        'read': self._tool('read', read_only=True)}
+        results = ToolScheduler(function_map, timeout=0.3).run([('slow', {}), ('m1', {}), ('m2', {}), ('read', {})])
+
+        self.assertEqual(results[0].error, 'timed out after 0.3s')
+        for result in results[1:]:
+            self.assertEqual(result.error, 'skipped, as earlier slow call did not finish')
+        time.sleep(1.0)
+        self.assertEqual([name for name, _, _ in self.calls], ['slow'])
+
+    def test_mutations_keep_their_order(self):
+        function_map = {'m1': self._tool('m1', 0.1), 'm2': self._tool('m2'), 'read': self._tool('read', read_only=True)}
+        results = ToolScheduler(function_map).run([('m1', {}), ('read', {}), ('m2', {})])
+
+        self.assertEqual([result.result for result in results], ['m1', 'read', 'm2'])
+        self.assertEqual([name for name, _, _ in self.calls], ['m1', 'read', 'm2'])
+
+
+if __name__ == '__main__':
+    unittest.main()